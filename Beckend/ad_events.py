@@ -0,0 +1,105 @@
+"""
+Batched ingestion of ad impressions and clicks.
+
+/ads/{ad_id}/view and /ads/{ad_id}/click only append to an in-memory
+queue. Each flush bulk-inserts the raw AdView/AdClick rows and applies
+the per-ad counter deltas with one aggregated UPDATE, all in a single
+transaction. Failed batches go back to the queue, and the queue is
+flushed on graceful shutdown, so delivery is at-least-once.
+"""
+import logging
+import os
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import bindparam, func, insert, select, update
+from dotenv import load_dotenv
+
+import models
+from database import AsyncSessionLocal
+from write_behind import BufferedWriter
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+VIEW = "view"
+CLICK = "click"
+
+
+class AdEventQueue(BufferedWriter):
+    def __init__(self, interval: float, batch_size: int, max_pending: int):
+        super().__init__("Ad events", interval)
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._events = []  # (kind, ad_id, ip_address, timestamp)
+
+    def add(self, kind: str, ad_id: int, ip_address: str = None):
+        if len(self._events) >= self.max_pending:
+            # Database has been unreachable for a while; shed load instead of growing without bound
+            self.dropped += 1
+            return
+        self._events.append((kind, ad_id, ip_address, datetime.utcnow()))
+        if len(self._events) == self.batch_size:
+            self._flush_soon()
+
+    def pending(self) -> int:
+        return len(self._events)
+
+    def _take(self):
+        batch, self._events = self._events, []
+        return batch
+
+    def _restore(self, batch):
+        self._events = batch + self._events
+
+    async def _write(self, batch):
+        async with AsyncSessionLocal() as db:
+            # Events for ads that no longer exist are discarded, as the old handlers did
+            ad_ids = {ad_id for _, ad_id, _, _ in batch}
+            known = set((await db.scalars(
+                select(models.Advertisement.id).where(models.Advertisement.id.in_(ad_ids))
+            )).all())
+
+            views, clicks = [], []
+            view_deltas, click_deltas = Counter(), Counter()
+            for kind, ad_id, ip_address, at in batch:
+                if ad_id not in known:
+                    continue
+                if kind == VIEW:
+                    views.append({"ad_id": ad_id, "ip_address": ip_address, "viewed_at": at})
+                    view_deltas[ad_id] += 1
+                else:
+                    clicks.append({"ad_id": ad_id, "ip_address": ip_address, "clicked_at": at})
+                    click_deltas[ad_id] += 1
+
+            if views:
+                await db.execute(insert(models.AdView), views)
+            if clicks:
+                await db.execute(insert(models.AdClick), clicks)
+
+            deltas = [
+                {"target_id": ad_id, "views": view_deltas[ad_id], "clicks": click_deltas[ad_id]}
+                for ad_id in set(view_deltas) | set(click_deltas)
+            ]
+            if deltas:
+                table = models.Advertisement.__table__
+                stmt = update(table).where(table.c.id == bindparam("target_id")).values(
+                    views_count=func.coalesce(table.c.views_count, 0) + bindparam("views"),
+                    clicks_count=func.coalesce(table.c.clicks_count, 0) + bindparam("clicks"),
+                )
+                await db.execute(stmt, deltas)
+            await db.commit()
+
+    def stats(self):
+        stats = super().stats()
+        stats["dropped"] = self.dropped
+        return stats
+
+
+ad_events = AdEventQueue(
+    interval=float(os.getenv("AD_EVENT_FLUSH_INTERVAL", "5")),
+    batch_size=int(os.getenv("AD_EVENT_BATCH_SIZE", "1000")),
+    max_pending=int(os.getenv("AD_EVENT_MAX_PENDING", "100000")),
+)
@@ -0,0 +1,105 @@
+"""
+In-memory ad serving index.
+
+Active ads are loaded once, pre-sorted by type and position, and the
+currently live subset (inside its start_date / end_date / expires_at
+window) is precomputed. Serving an ad is a dict lookup with no database
+query. The live subset is recomputed from the snapshot when the next
+window boundary passes. The snapshot is reloaded after admin changes
+(invalidate()) or after AD_INDEX_MAX_AGE seconds, which picks up changes
+made through other workers.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import select
+from dotenv import load_dotenv
+
+import models
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+def _window_bounds(ad: dict):
+    return ad["start_date"], [d for d in (ad["end_date"], ad["expires_at"]) if d is not None]
+
+
+def is_live(ad: dict, now: datetime) -> bool:
+    start, ends = _window_bounds(ad)
+    if start is not None and now < start:
+        return False
+    return all(now < end for end in ends)
+
+
+class AdServingIndex:
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self.reloads = 0
+        self._ads = []  # every active ad, sorted by (type, position, id)
+        self._live = {}  # ad_type -> live ads in serving order
+        self._next_boundary = None
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age
+
+    async def _reload(self):
+        async with AsyncSessionLocal() as db:
+            ads = (await db.scalars(
+                select(models.Advertisement).where(models.Advertisement.is_active == True)
+            )).all()
+        columns = [c.name for c in models.Advertisement.__table__.columns]
+        snapshot = [{name: getattr(ad, name) for name in columns} for ad in ads]
+        # Ads without a position go last, ties broken by id like the old unordered queries
+        snapshot.sort(key=lambda ad: (ad["position"] is None, ad["position"] or 0, ad["id"]))
+        self._ads = snapshot
+        self._loaded_at = time.monotonic()
+        self.reloads += 1
+        self._rebuild(datetime.utcnow())
+
+    def _rebuild(self, now: datetime):
+        live = {ad_type: [] for ad_type in models.AdType}
+        next_boundary = None
+        for ad in self._ads:
+            if is_live(ad, now):
+                live[models.AdType(ad["ad_type"])].append(ad)
+            # The earliest future start/end decides when the live set changes next
+            start, ends = _window_bounds(ad)
+            for boundary in [start] + ends:
+                if boundary is not None and boundary > now and (next_boundary is None or boundary < next_boundary):
+                    next_boundary = boundary
+        self._live = live
+        self._next_boundary = next_boundary
+
+    async def get(self, ad_type: models.AdType):
+        if self._stale():
+            async with self._lock:
+                # Another request may have reloaded while we waited for the lock
+                if self._stale():
+                    await self._reload()
+        now = datetime.utcnow()
+        if self._next_boundary is not None and now >= self._next_boundary:
+            self._rebuild(now)
+        return self._live.get(ad_type, [])
+
+    def stats(self):
+        return {
+            "ads": len(self._ads),
+            "live": {ad_type.value: len(ads) for ad_type, ads in self._live.items()},
+            "next_boundary": self._next_boundary,
+            "reloads": self.reloads,
+            "max_age": self.max_age,
+        }
+
+
+ad_index = AdServingIndex(max_age=float(os.getenv("AD_INDEX_MAX_AGE", "60")))
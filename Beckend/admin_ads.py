@@ -1,9 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Request
-from sqlalchemy.orm import Session
-import models, schemas, auth, image_utils
+from sqlalchemy.ext.asyncio import AsyncSession
+import models, schemas, auth, image_utils, cache, database, write_behind, uploads, realtime, quotas, archive
+from ad_events import ad_events, VIEW, CLICK
+from ad_index import ad_index
+from image_engine import image_engine
+from image_jobs import image_jobs
 from database import get_db
 from datetime import datetime
-from sqlalchemy import func
+from sqlalchemy import func, select
 import os
 from jose import jwt
 
@@ -23,7 +27,7 @@ def check_admin(user: models.User = Depends(auth.get_current_user)):
 # === ADMIN AUTHENTICATION ===
 
 @router.post("/admin/login")
-async def admin_login(data: schemas.AdminLoginRequest, db: Session = Depends(get_db)):
+async def admin_login(data: schemas.AdminLoginRequest, db: AsyncSession = Depends(get_db)):
     try:
         username = data.username
         password = data.password
@@ -32,7 +36,7 @@ async def admin_login(data: schemas.AdminLoginRequest, db: Session = Depends(get
         
         if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
             # Check if admin user exists in DB
-            user = db.query(models.User).filter(models.User.phone == username).first()
+            user = await db.scalar(select(models.User).where(models.User.phone == username))
             if not user:
                 user = models.User(
                     phone=username,
@@ -40,11 +44,12 @@ async def admin_login(data: schemas.AdminLoginRequest, db: Session = Depends(get
                     username="admin"
                 )
                 db.add(user)
-                db.commit()
-                db.refresh(user)
+                await db.commit()
+                await db.refresh(user)
             elif user.role != models.UserRole.admin:
                 user.role = models.UserRole.admin
-                db.commit()
+                await db.commit()
+                auth.invalidate_user(user.phone)
 
             # Create standard access token
             token = auth.create_access_token(data={"sub": user.phone})
@@ -60,60 +65,40 @@ async def admin_login(data: schemas.AdminLoginRequest, db: Session = Depends(get
 # === ADVERTISEMENT ENDPOINTS ===
 
 @router.get("/ads/splash")
-async def get_splash_ad(db: Session = Depends(get_db)):
+async def get_splash_ad():
     """Get active splash ad"""
-    ad = db.query(models.Advertisement).filter(
-        models.Advertisement.ad_type == models.AdType.splash,
-        models.Advertisement.is_active == True
-    ).first()
-    return ad
+    ads = await ad_index.get(models.AdType.splash)
+    return ads[0] if ads else None
 
 @router.get("/ads/banners")
-async def get_banner_ads(db: Session = Depends(get_db)):
+async def get_banner_ads():
     """Get 3 active banner ads"""
-    ads = db.query(models.Advertisement).filter(
-        models.Advertisement.ad_type == models.AdType.banner,
-        models.Advertisement.is_active == True
-    ).order_by(models.Advertisement.position).limit(3).all()
-    return ads
+    ads = await ad_index.get(models.AdType.banner)
+    return ads[:3]
 
 @router.get("/ads/inline")
-async def get_inline_ads(db: Session = Depends(get_db)):
+async def get_inline_ads():
     """Get active inline ads"""
-    ads = db.query(models.Advertisement).filter(
-        models.Advertisement.ad_type == models.AdType.inline,
-        models.Advertisement.is_active == True
-    ).all()
-    return ads
+    return await ad_index.get(models.AdType.inline)
 
 @router.post("/ads/{ad_id}/view")
-async def track_ad_view(ad_id: int, db: Session = Depends(get_db)):
-    """Track ad view"""
-    ad = db.query(models.Advertisement).filter(models.Advertisement.id == ad_id).first()
-    if ad:
-        ad.views_count += 1
-        view = models.AdView(ad_id=ad_id)
-        db.add(view)
-        db.commit()
+async def track_ad_view(ad_id: int, request: Request):
+    """Track ad view (queued, written in batches)"""
+    ad_events.add(VIEW, ad_id, request.client.host if request.client else None)
     return {"success": True}
 
 @router.post("/ads/{ad_id}/click")
-async def track_ad_click(ad_id: int, db: Session = Depends(get_db)):
-    """Track ad click"""
-    ad = db.query(models.Advertisement).filter(models.Advertisement.id == ad_id).first()
-    if ad:
-        ad.clicks_count += 1
-        click = models.AdClick(ad_id=ad_id)
-        db.add(click)
-        db.commit()
+async def track_ad_click(ad_id: int, request: Request):
+    """Track ad click (queued, written in batches)"""
+    ad_events.add(CLICK, ad_id, request.client.host if request.client else None)
     return {"success": True}
 
 # === ADMIN ADVERTISEMENT CRUD ===
 
 @router.get("/admin/ads", dependencies=[Depends(check_admin)])
-async def get_all_ads(db: Session = Depends(get_db)):
+async def get_all_ads(db: AsyncSession = Depends(get_db)):
     """Get all advertisements"""
-    return db.query(models.Advertisement).all()
+    return (await db.scalars(select(models.Advertisement))).all()
 
 @router.post("/admin/ads", dependencies=[Depends(check_admin)])
 async def create_ad(
@@ -122,11 +107,11 @@ async def create_ad(
     ad_type: str = Form(...),
     position: int = Form(None),
     file: UploadFile = File(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Create new advertisement"""
-    file_content = await file.read()
-    image_url = await image_utils.upload_image(file_content, file.filename)
+    async with await uploads.spool_upload(file) as upload:
+        image_url = await image_utils.upload_image(upload.path, upload.filename)
     
     if not image_url:
         raise HTTPException(status_code=500, detail="Image upload failed")
@@ -139,58 +124,65 @@ async def create_ad(
         position=position
     )
     db.add(ad)
-    db.commit()
-    db.refresh(ad)
+    await db.commit()
+    await db.refresh(ad)
+    ad_index.invalidate()
     return ad
 
 @router.put("/admin/ads/{ad_id}", dependencies=[Depends(check_admin)])
-async def update_ad(ad_id: int, is_active: bool, db: Session = Depends(get_db)):
+async def update_ad(ad_id: int, is_active: bool, db: AsyncSession = Depends(get_db)):
     """Update advertisement status"""
-    ad = db.query(models.Advertisement).filter(models.Advertisement.id == ad_id).first()
+    ad = await db.get(models.Advertisement, ad_id)
     if not ad:
         raise HTTPException(status_code=404, detail="Ad not found")
     ad.is_active = is_active
-    db.commit()
+    await db.commit()
+    ad_index.invalidate()
     return ad
 
 @router.delete("/admin/ads/{ad_id}", dependencies=[Depends(check_admin)])
-async def delete_ad(ad_id: int, db: Session = Depends(get_db)):
+async def delete_ad(ad_id: int, db: AsyncSession = Depends(get_db)):
     """Delete advertisement"""
-    ad = db.query(models.Advertisement).filter(models.Advertisement.id == ad_id).first()
+    ad = await db.get(models.Advertisement, ad_id)
     if not ad:
         raise HTTPException(status_code=404, detail="Ad not found")
-    db.delete(ad)
-    db.commit()
+    image_url = ad.image_url
+    await db.delete(ad)
+    await db.commit()
+    ad_index.invalidate()
+    await image_utils.release_image(image_url)
     return {"success": True}
 
 # === ADMIN ANALYTICS ===
 
 @router.get("/admin/stats/overview", dependencies=[Depends(check_admin)])
-async def get_overview_stats(db: Session = Depends(get_db)):
+async def get_overview_stats(db: AsyncSession = Depends(get_db)):
     """Get platform overview statistics"""
-    total_users = db.query(models.User).count()
-    total_listings = db.query(models.PortfolioItem).count()
-    total_messages = db.query(models.Message).count()
-    total_reviews = db.query(models.Review).count()
+    total_users = await db.scalar(select(func.count()).select_from(models.User))
+    total_listings = await db.scalar(select(func.count()).select_from(models.PortfolioItem))
+    hot_messages = await db.scalar(select(func.count()).select_from(models.Message))
+    archived_messages = await db.scalar(select(func.count()).select_from(models.ArchivedMessage))
+    total_reviews = await db.scalar(select(func.count()).select_from(models.Review))
     
     # Users by role
-    users_by_role = db.query(
+    users_by_role = (await db.execute(select(
         models.User.role,
         func.count(models.User.id)
-    ).group_by(models.User.role).all()
+    ).group_by(models.User.role))).all()
     
     return {
         "total_users": total_users,
         "total_listings": total_listings,
-        "total_messages": total_messages,
+        "total_messages": hot_messages + archived_messages,
+        "archived_messages": archived_messages,
         "total_reviews": total_reviews,
         "users_by_role": dict(users_by_role)
     }
 
 @router.get("/admin/stats/ads", dependencies=[Depends(check_admin)])
-async def get_ad_stats(db: Session = Depends(get_db)):
+async def get_ad_stats(db: AsyncSession = Depends(get_db)):
     """Get advertisement statistics"""
-    ads = db.query(models.Advertisement).all()
+    ads = (await db.scalars(select(models.Advertisement))).all()
     
     stats = []
     for ad in ads:
@@ -205,3 +197,50 @@ async def get_ad_stats(db: Session = Depends(get_db)):
         })
     
     return stats
+
+@router.get("/admin/stats/cache", dependencies=[Depends(check_admin)])
+async def get_cache_stats():
+    """Get response cache hit/miss counters"""
+    return cache.response_cache.stats()
+
+@router.get("/admin/stats/db", dependencies=[Depends(check_admin)])
+async def get_db_pool_stats():
+    """Get database connection pool statistics"""
+    return database.pool_status()
+
+@router.get("/admin/stats/buffers", dependencies=[Depends(check_admin)])
+async def get_buffer_stats():
+    """Get write-behind buffer statistics"""
+    return {"views": write_behind.view_counter.stats(), "ad_events": ad_events.stats()}
+
+@router.get("/admin/stats/ad-index", dependencies=[Depends(check_admin)])
+async def get_ad_index_stats():
+    """Get ad serving index state"""
+    return ad_index.stats()
+
+@router.get("/admin/stats/realtime", dependencies=[Depends(check_admin)])
+async def get_realtime_stats():
+    """Get WebSocket connection and event counters for this worker"""
+    return realtime.hub.stats()
+
+@router.get("/admin/stats/quotas", dependencies=[Depends(check_admin)])
+async def get_quota_stats():
+    """Get quota engine counters"""
+    return quotas.engine.stats()
+
+@router.get("/admin/stats/archive", dependencies=[Depends(check_admin)])
+async def get_archive_stats():
+    """Get message archiver counters for this worker"""
+    return archive.message_archiver.stats()
+
+@router.get("/admin/stats/images", dependencies=[Depends(check_admin)])
+async def get_image_stats(db: AsyncSession = Depends(get_db)):
+    """Get image engine queue, per-stage timings, upload dedup counters and background job queue"""
+    stats = image_engine.stats()
+    stats["dedup"] = image_utils.dedup_stats
+    stats["storage"] = image_utils.storage.stats()
+    stats["jobs"] = image_jobs.stats()
+    stats["jobs"]["queue"] = dict((await db.execute(
+        select(models.ImageJob.status, func.count()).group_by(models.ImageJob.status)
+    )).all())
+    return stats
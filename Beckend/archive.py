@@ -0,0 +1,144 @@
+"""
+Cold storage for old chat messages.
+
+A background task moves messages older than MESSAGE_ARCHIVE_DAYS from
+`messages` into `messages_archive`, a batch at a time (insert + delete in
+one transaction), so the hot table and every chat, inbox and admin query
+on it stay proportional to recent traffic instead of all history.
+
+Ids are kept and grow with created_at, and `messages` never reuses one
+(AUTOINCREMENT on SQLite, a sequence on PostgreSQL), so every archived id
+is below every hot one. Readers page through `messages` first and only
+continue into the archive when the hot rows run out (see get_chat_history
+in main.py).
+
+MESSAGE_ARCHIVE_DAYS=0 turns archiving off; the read path keeps working.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.exc import IntegrityError
+from dotenv import load_dotenv
+
+import models
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Columns copied as-is; archived_at is filled in by its default
+_COLUMNS = [c.name for c in models.Message.__table__.columns]
+
+
+async def max_archived_id(db) -> int:
+    """Highest archived message id (a primary key lookup); 0 when the archive is empty."""
+    return await db.scalar(select(func.max(models.ArchivedMessage.id))) or 0
+
+
+class MessageArchiver:
+    def __init__(self, age_days: int, batch_size: int, interval: float):
+        self.age_days = age_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.runs = 0
+        self.moved = 0
+        self.failures = 0
+        self.conflicts = 0
+        self.last_error = None
+        self.last_run_at = None
+        self._task = None
+
+    async def _move_batch(self, cutoff) -> tuple:
+        """Archives the oldest messages up to cutoff; returns (moved, done)."""
+        message = models.Message
+        async with AsyncSessionLocal() as db:
+            # Walk the primary key from the oldest row: no created_at index needed, and it
+            # stops at the first recent row instead of scanning the table when nothing is due
+            rows = (await db.execute(
+                select(message.id, message.created_at).order_by(message.id).limit(self.batch_size)
+            )).all()
+            ids = []
+            for row in rows:
+                # Rows from before created_at had a default count as old
+                if row.created_at is not None and row.created_at >= cutoff:
+                    break
+                ids.append(row.id)
+            if ids:
+                columns = [message.__table__.c[name] for name in _COLUMNS]
+                await db.execute(insert(models.ArchivedMessage).from_select(
+                    _COLUMNS, select(*columns).where(message.id.in_(ids))
+                ))
+                await db.execute(delete(message).where(message.id.in_(ids)))
+                await db.commit()
+        return len(ids), len(ids) < len(rows) or len(rows) < self.batch_size
+
+    async def run_once(self) -> int:
+        """Moves everything that is due; returns the number of messages archived."""
+        cutoff = datetime.utcnow() - timedelta(days=self.age_days)
+        moved = 0
+        self.runs += 1
+        self.last_run_at = datetime.utcnow()
+        while True:
+            try:
+                count, done = await self._move_batch(cutoff)
+            except IntegrityError as e:
+                # An id that is already archived: the hot and cold tables disagree, and every
+                # run will stop at the same batch until someone repairs them, so make it visible
+                self.failures += 1
+                self.conflicts += 1
+                self.last_error = f"{datetime.utcnow():%Y-%m-%d %H:%M:%S} archive id conflict: {e.orig}"
+                logger.error(f"Message archive batch conflicts with archived ids: {e}")
+                break
+            moved += count
+            self.moved += count
+            if done:
+                break
+            await asyncio.sleep(0)  # let requests in between batches
+        if moved:
+            logger.info(f"Archived {moved} messages older than {cutoff:%Y-%m-%d}")
+        return moved
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f"{datetime.utcnow():%Y-%m-%d %H:%M:%S} {e}"
+                logger.error(f"Message archiving failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.age_days > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {
+            "enabled": self.age_days > 0,
+            "age_days": self.age_days,
+            "runs": self.runs,
+            "moved": self.moved,
+            "failures": self.failures,
+            "conflicts": self.conflicts,  # > 0: stuck on ids present in both tables
+            "last_error": self.last_error,
+            "last_run_at": self.last_run_at,
+        }
+
+
+message_archiver = MessageArchiver(
+    age_days=int(os.getenv("MESSAGE_ARCHIVE_DAYS", "180")),
+    batch_size=int(os.getenv("MESSAGE_ARCHIVE_BATCH", "500")),
+    interval=float(os.getenv("MESSAGE_ARCHIVE_INTERVAL", "3600")),
+)
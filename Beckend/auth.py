@@ -1,14 +1,18 @@
 import os
 import random
 import string
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-import models, schemas, database
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import models, database
 from dotenv import load_dotenv
 import httpx
 
@@ -47,7 +51,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def send_telegram_otp(phone: str, db: Session, telegram_id: Optional[int] = None):
+async def send_telegram_otp(phone: str, db: AsyncSession, telegram_id: Optional[int] = None):
     # Google Play Reviewer Bypass
     if phone == "+998990001111":
         otp = "123456"
@@ -55,11 +59,11 @@ async def send_telegram_otp(phone: str, db: Session, telegram_id: Optional[int]
         otp = "".join(random.choices(string.digits, k=6))
     
     # Save to DB
-    user = db.query(models.User).filter(models.User.phone == phone).first()
+    user = await db.scalar(select(models.User).where(models.User.phone == phone))
     if user:
         user.otp_code = otp
         user.otp_created_at = datetime.utcnow()
-        db.commit()
+        await db.commit()
     
     print(f"OTP for {phone}: {otp}")
     
@@ -78,34 +82,102 @@ async def send_telegram_otp(phone: str, db: Session, telegram_id: Optional[int]
                 logger.error(f"Error sending TG message: {e}")
     return otp
 
-def get_current_user(db: Session = Depends(database.get_db), token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+# --- Authenticated user cache ---
+# Maps a raw bearer token to a snapshot of its user so warm requests skip
+# jwt.decode and the users lookup. Entries live at most AUTH_CACHE_TTL seconds
+# (and never past the token's own expiry); endpoints that change a user call
+# invalidate_user() so the next request sees fresh data. The cache is per
+# process: writes made elsewhere (the Telegram bot linking telegram_id, other
+# workers) show up once the entry expires, so keep the TTL short.
+
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "30"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+_SNAPSHOT_FIELDS = ("id", "phone", "telegram_id", "role", "rating", "username", "phone_visible", "preferred_language", "created_at")
+
+_user_cache = OrderedDict()  # token -> (expires_at, snapshot)
+_tokens_by_phone = {}  # phone -> set of tokens
+_user_cache_lock = threading.Lock()
+
+def _cache_user(token: str, user: models.User, token_exp: Optional[float]):
+    expires_at = time.time() + AUTH_CACHE_TTL
+    if token_exp:
+        expires_at = min(expires_at, token_exp)
+    snapshot = {field: getattr(user, field) for field in _SNAPSHOT_FIELDS}
+    with _user_cache_lock:
+        _user_cache[token] = (expires_at, snapshot)
+        _tokens_by_phone.setdefault(user.phone, set()).add(token)
+        while len(_user_cache) > AUTH_CACHE_MAX_ENTRIES:
+            _drop_token(next(iter(_user_cache)))
+
+def _cached_user(token: str) -> Optional[models.User]:
+    with _user_cache_lock:
+        entry = _user_cache.get(token)
+        if entry is None:
+            return None
+        expires_at, snapshot = entry
+        if expires_at < time.time():
+            _drop_token(token)
+            return None
+        _user_cache.move_to_end(token)
+    # Fresh detached instance per request, so handlers can't leak changes into the cache
+    return models.User(**snapshot)
+
+def _drop_token(token: str):
+    entry = _user_cache.pop(token, None)
+    if entry:
+        phone = entry[1]["phone"]
+        tokens = _tokens_by_phone.get(phone)
+        if tokens:
+            tokens.discard(token)
+            if not tokens:
+                del _tokens_by_phone[phone]
+
+def invalidate_user(phone: str):
+    """Drops cached snapshots of the user; call after changing any users row."""
+    with _user_cache_lock:
+        for token in list(_tokens_by_phone.get(phone, ())):
+            _drop_token(token)
+
+async def _resolve_user(db: AsyncSession, token: str) -> Optional[models.User]:
+    user = _cached_user(token)
+    if user is not None:
+        return user
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phone: str = payload.get("sub")
-        if phone is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(phone=phone)
     except JWTError:
-        raise credentials_exception
-    user = db.query(models.User).filter(models.User.phone == token_data.phone).first()
+        return None
+    phone: str = payload.get("sub")
+    if phone is None:
+        return None
+    user = await db.scalar(select(models.User).where(models.User.phone == phone))
+    if user is None:
+        return None
+    _cache_user(token, user, payload.get("exp"))
+    return user
+
+async def get_current_user(db: AsyncSession = Depends(database.get_db), token: str = Depends(oauth2_scheme)):
+    """
+    Returns the authenticated user. The object may be a detached snapshot:
+    handlers that modify the user must load it from their own session first.
+    """
+    user = await _resolve_user(db, token)
     if user is None:
-        raise credentials_exception
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
 
-async def get_current_user_optional(db: Session = Depends(database.get_db), token: Optional[str] = Depends(oauth2_scheme)):
+async def authenticate_token(token: Optional[str]) -> Optional[models.User]:
+    """Resolves a raw token outside dependency injection (e.g. a WebSocket query parameter)."""
     if not token:
         return None
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phone: str = payload.get("sub")
-        if phone is None:
-            return None
-        user = db.query(models.User).filter(models.User.phone == phone).first()
-        return user
-    except JWTError:
+    async with database.AsyncSessionLocal() as db:
+        return await _resolve_user(db, token)
+
+async def get_current_user_optional(db: AsyncSession = Depends(database.get_db), token: Optional[str] = Depends(oauth2_scheme)):
+    if not token:
         return None
+    return await _resolve_user(db, token)
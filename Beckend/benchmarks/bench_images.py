@@ -0,0 +1,343 @@
+"""
+Image hot path benchmark: pipeline stages, the compress/watermark/variant
+entry points and upload_image_variants against local storage.
+
+    cd Beckend && python benchmarks/bench_images.py [--rounds 3] [--workers N]
+                                                    [--threshold 0.15] [--fail-on-regression]
+
+A synthetic corpus covers the inputs that behave differently: PNG with
+alpha, a 54 MP JPEG (draft decode), a palette GIF and an EXIF-rotated phone
+photo. Each image is measured in a fresh process, so peak RSS is per image.
+
+Results are written to benchmarks/results/images.json; the previous file
+there is the baseline, and metrics that got worse by more than --threshold
+are listed (and exit 1 with --fail-on-regression). Use --baseline to
+compare against a saved run instead, e.g. one taken on master.
+"""
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import PIL  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import image_pipeline  # noqa: E402
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "images.json")
+
+# name -> (width, height) of the stored image
+CORPUS = {
+    "png_alpha": (2400, 1800),
+    "jpeg_huge": (9000, 6000),
+    "gif_palette": (1600, 1200),
+    "jpeg_exif_rotated": (4032, 3024),
+}
+
+
+# --- Corpus ---
+
+def _photo(size):
+    """Smooth gradients plus blurred noise: compresses like a photo, unlike flat colour or white noise."""
+    width, height = size
+    gradient = Image.linear_gradient("L").resize(size)
+    texture = Image.effect_noise((max(1, width // 16), max(1, height // 16)), 60).resize(size, Image.Resampling.BILINEAR)
+    diagonal = Image.radial_gradient("L").resize(size)
+    return Image.merge("RGB", (gradient, texture, diagonal))
+
+
+def build_corpus(directory):
+    paths = {}
+    for name, size in CORPUS.items():
+        img = _photo(size)
+        path = os.path.join(directory, name)
+        if name == "png_alpha":
+            img.putalpha(Image.radial_gradient("L").resize(size))
+            path += ".png"
+            img.save(path, optimize=False)
+        elif name == "gif_palette":
+            path += ".gif"
+            img.convert("P", palette=Image.Palette.ADAPTIVE, colors=256).save(path)
+        elif name == "jpeg_exif_rotated":
+            # Stored landscape, displayed portrait: orient() has to rotate it
+            exif = Image.Exif()
+            exif[0x0112] = 6
+            path += ".jpg"
+            img.save(path, quality=92, exif=exif)
+        else:
+            path += ".jpg"
+            img.save(path, quality=92)
+        paths[name] = path
+    return paths
+
+
+# --- Measurements (each runs in its own spawned process) ---
+
+def _peak_rss_mb():
+    # ru_maxrss survives exec, so a spawned child would report the parent's peak; VmHWM does not
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _median_ms(samples):
+    return round(statistics.median(samples) * 1000, 2)
+
+
+def measure_image(path, rounds):
+    """Per-stage wall time of the pipeline plus the public entry points, for one corpus image."""
+    image_pipeline.watermark(Image.new("RGB", (64, 64)))  # logo decode is per process, not per image
+    stages = {name: [] for name in ("decode", "orient", "to_rgb", "downscale", "watermark", "encode", "variants")}
+    for _ in range(rounds):
+        started = time.perf_counter()
+        img = image_pipeline.decode(path)
+        stages["decode"].append(time.perf_counter() - started)
+        for stage in ("orient", "to_rgb", "downscale", "watermark"):
+            started = time.perf_counter()
+            img = getattr(image_pipeline, stage)(img)
+            stages[stage].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        original = image_pipeline.encode(img)
+        stages["encode"].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        variant_bytes = 0
+        for size in image_pipeline.VARIANT_SIZES.values():
+            if max(img.size) > size:
+                img = img.copy()
+                img.thumbnail((size, size), Image.Resampling.LANCZOS)
+            variant_bytes += len(image_pipeline.encode_webp(img)) + len(image_pipeline.encode(img))
+        stages["variants"].append(time.perf_counter() - started)
+
+    calls = {
+        "compress_image": lambda: image_pipeline.compress_image(path),
+        "apply_watermark": lambda: image_pipeline.apply_watermark(path),
+        "process_image_variants": lambda: image_pipeline.process_image_variants(path, True),
+    }
+    entry_points = {}
+    for name, call in calls.items():
+        samples = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            call()
+            samples.append(time.perf_counter() - started)
+        entry_points[name] = _median_ms(samples)
+
+    with Image.open(io.BytesIO(original)) as out:
+        output_size = list(out.size)
+    return {
+        "input_bytes": os.path.getsize(path),
+        "output_bytes": len(original),
+        "variant_bytes": variant_bytes,
+        "output_size": output_size,
+        "stages_ms": {name: _median_ms(samples) for name, samples in stages.items()},
+        "entry_points_ms": entry_points,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _process_one(path):
+    image_pipeline.process_image_variants(path, True)
+
+
+def measure_throughput(paths, workers, rounds):
+    """process_image_variants over the corpus on `workers` processes, as the image engine runs it."""
+    jobs = list(paths.values()) * rounds
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers) as pool:
+        pool.map(_process_one, list(paths.values()))  # warm-up: imports and logo cache
+        started = time.perf_counter()
+        pool.map(_process_one, jobs, chunksize=1)
+        elapsed = time.perf_counter() - started
+    images_per_sec = len(jobs) / elapsed
+    return {
+        "workers": workers,
+        "images": len(jobs),
+        "images_per_sec": round(images_per_sec, 2),
+        "images_per_sec_per_core": round(images_per_sec / workers, 2),
+    }
+
+
+def measure_upload(paths, rounds, directory):
+    """
+    upload_image_variants end to end: hashing, the image engine, dedup index
+    and storage puts, with LocalStorage in a temp dir and a throwaway SQLite
+    database. "cold" uploads unique bytes, "dedup_hit" repeats them.
+    """
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["MEDIA_ROOT"] = os.path.join(directory, "media")
+    os.environ["DATABASE_URL"] = "sqlite://"
+    # database.py opens ./megastroy.db relative to the working directory
+    os.chdir(directory)
+    import database
+    import models
+    import image_utils
+    from image_engine import image_engine
+    models.Base.metadata.create_all(database.engine)
+
+    async def run():
+        results = {}
+        for name, path in paths.items():
+            with open(path, "rb") as f:
+                content = f.read()
+            cold, hits = [], []
+            for round_index in range(rounds):
+                # Trailing bytes after the image data make every round a dedup miss
+                unique = content + f"bench-{name}-{round_index}-{time.time_ns()}".encode()
+                started = time.perf_counter()
+                assert await image_utils.upload_image_variants(unique, os.path.basename(path))
+                cold.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                await image_utils.upload_image_variants(unique, os.path.basename(path))
+                hits.append(time.perf_counter() - started)
+            results[name] = {"cold_ms": _median_ms(cold), "dedup_hit_ms": _median_ms(hits)}
+        return results
+
+    try:
+        return asyncio.run(run())
+    finally:
+        image_engine.shutdown()
+        os.chdir(BACKEND_DIR)
+
+
+# --- Comparison ---
+
+def _flatten(results):
+    """Metrics where a bigger number is worse, as dotted keys."""
+    flat = {}
+    for name, image in results["images"].items():
+        for stage, value in image["stages_ms"].items():
+            flat[f"{name}.stage.{stage}_ms"] = value
+        for entry_point, value in image["entry_points_ms"].items():
+            flat[f"{name}.{entry_point}_ms"] = value
+        for key in ("output_bytes", "variant_bytes", "peak_rss_mb"):
+            flat[f"{name}.{key}"] = image[key]
+    for name, upload in results.get("upload", {}).items():
+        for key, value in upload.items():
+            flat[f"{name}.upload.{key}"] = value
+    throughput = results["throughput"]["images_per_sec_per_core"]
+    # Inverted so that, like every other metric, higher means slower
+    flat["throughput.sec_per_image_per_core"] = round(1 / throughput, 4) if throughput else None
+    return flat
+
+
+def compare(current, baseline, threshold, min_delta_ms=1.0):
+    """Returns [(metric, before, after, change)] for metrics worse than the threshold."""
+    before, after = _flatten(baseline), _flatten(current)
+    regressions = []
+    for key, new in after.items():
+        old = before.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        # Sub-millisecond stages jitter by more than the threshold on their own
+        if key.endswith("_ms") and new - old < min_delta_ms:
+            continue
+        if change > threshold:
+            regressions.append((key, old, new, change))
+    return regressions
+
+
+# --- Report ---
+
+def print_report(results):
+    print(f"{'image':<18} {'in KB':>8} {'out KB':>8} {'var KB':>8} {'RSS MB':>7}  stage ms")
+    for name, image in results["images"].items():
+        stages = " ".join(f"{stage}={value}" for stage, value in image["stages_ms"].items())
+        print(f"{name:<18} {image['input_bytes'] / 1024:>8.0f} {image['output_bytes'] / 1024:>8.0f} "
+              f"{image['variant_bytes'] / 1024:>8.0f} {image['peak_rss_mb']:>7}  {stages}")
+    print()
+    print(f"{'image':<18} {'compress':>9} {'watermark':>10} {'variants':>9} {'upload':>8} {'dedup hit':>10}   (ms)")
+    for name, image in results["images"].items():
+        entry = image["entry_points_ms"]
+        upload = results.get("upload", {}).get(name, {})
+        print(f"{name:<18} {entry['compress_image']:>9} {entry['apply_watermark']:>10} "
+              f"{entry['process_image_variants']:>9} {upload.get('cold_ms', '-'):>8} {upload.get('dedup_hit_ms', '-'):>10}")
+    throughput = results["throughput"]
+    print()
+    print(f"throughput: {throughput['images_per_sec']} images/s on {throughput['workers']} workers "
+          f"({throughput['images_per_sec_per_core']} per core)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threshold", type=float, default=0.15, help="relative slowdown reported as a regression")
+    parser.add_argument("--baseline", help=f"results file to compare against (default: the previous {RESULTS_PATH})")
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--skip-upload", action="store_true")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    baseline_path = args.baseline or args.output
+    baseline = None
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory(prefix="bench-images-") as directory:
+        paths = build_corpus(directory)
+        context = multiprocessing.get_context("spawn")
+        images = {}
+        for name, path in paths.items():
+            # One process per image so ru_maxrss is that image's peak, not the run's
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                images[name] = pool.apply(measure_image, (path, args.rounds))
+        results = {
+            "meta": {
+                "date": datetime.utcnow().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "pillow": PIL.__version__,
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count(),
+                "rounds": args.rounds,
+            },
+            "images": images,
+            "throughput": measure_throughput(paths, args.workers, args.rounds),
+        }
+        if not args.skip_upload:
+            results["upload"] = measure_upload(paths, args.rounds, directory)
+
+    print_report(results)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {args.output}")
+
+    if baseline is None:
+        print("no baseline yet; the next run compares against this one")
+        return
+    regressions = compare(results, baseline, args.threshold)
+    print(f"compared with {baseline_path} ({baseline['meta']['date']}): ", end="")
+    if not regressions:
+        print(f"no metric worse by more than {args.threshold:.0%}")
+        return
+    print(f"{len(regressions)} regression(s)")
+    for key, old, new, change in regressions:
+        print(f"  {key:<48} {old:>10} -> {new:<10} (+{change:.0%})")
+    if args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
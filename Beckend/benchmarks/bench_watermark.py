@@ -0,0 +1,67 @@
+"""
+Watermark stage benchmark: per-upload logo decode + resize vs the cached,
+pre-scaled logo.
+
+    cd Beckend && python benchmarks/bench_watermark.py [--rounds 20]
+
+Only the watermark stage is timed; decode/encode of the photo itself are
+the same for both variants.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+import image_pipeline  # noqa: E402
+
+WIDTHS = [800, 1280, 1920, 3024, 4000]
+
+
+def uncached_watermark(img):
+    """The previous implementation: open, check and resize logo.png for every image."""
+    if not os.path.exists(image_pipeline.LOGO_PATH):
+        return img
+    logo = Image.open(image_pipeline.LOGO_PATH)
+    target_width = max(1, int(img.width * 0.15))
+    target_height = max(1, int(logo.height * target_width / logo.width))
+    logo = logo.resize((target_width, target_height), Image.Resampling.LANCZOS)
+    padding = 20
+    position = (img.width - logo.width - padding, img.height - logo.height - padding)
+    img.paste(logo, position, logo if "A" in logo.getbands() else None)
+    return img
+
+
+def bench(fn, width, rounds):
+    base = Image.new("RGB", (width, width * 3 // 4), (200, 200, 200))
+    images = [base.copy() for _ in range(rounds)]
+    started = time.perf_counter()
+    for img in images:
+        fn(img)
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    if image_pipeline._logo() is None:
+        sys.exit(f"logo.png not found at {image_pipeline.LOGO_PATH}")
+    # Warm the cache as a long-running worker would be after its first few uploads
+    for width in WIDTHS:
+        image_pipeline.watermark(Image.new("RGB", (width, width * 3 // 4)))
+
+    print(f"{'width':>6} {'uncached ms':>12} {'cached ms':>10} {'saved ms':>9} {'speedup':>8}")
+    for width in WIDTHS:
+        before = bench(uncached_watermark, width, args.rounds)
+        after = bench(image_pipeline.watermark, width, args.rounds)
+        print(f"{width:>6} {before:>12.2f} {after:>10.2f} {before - after:>9.2f} {before / after:>7.1f}x")
+    print(f"cache: {image_pipeline._scaled_logo.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Read-through response cache for public GET endpoints.
+
+Entries expire after a TTL, the in-process backend evicts least recently
+used entries once it is full, and every entry carries tags so write
+endpoints can drop everything derived from the rows they touched:
+
+    data = await cache.response_cache.get_or_set(key, loader, tags=["items"])
+    await cache.response_cache.invalidate("items", f"portfolio:{user_id}")
+
+Backend is chosen by CACHE_BACKEND: "memory" (default, per process) or
+"redis" (shared between workers, CACHE_REDIS_URL). Cached values must be
+JSON-serializable, so handlers cache schema dumps rather than ORM objects.
+"""
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Iterable
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+_MISSING = object()
+
+
+class MemoryBackend:
+    """LRU + TTL cache held in this process."""
+
+    def __init__(self, max_entries: int = 2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tags = {}  # tag -> set of keys
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value, _ = entry
+        if expires_at < time.monotonic():
+            self._drop(key)
+            return _MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: int, tags: Iterable[str]):
+        if key in self._entries:
+            self._drop(key)
+        tags = tuple(tags)
+        self._entries[key] = (time.monotonic() + ttl, value, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    async def invalidate_tags(self, tags: Iterable[str]):
+        for tag in tags:
+            for key in self._tags.pop(tag, set()):
+                self._drop(key)
+
+    async def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+
+    def size(self):
+        return len(self._entries)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisBackend:
+    """Cache shared by all workers; TTL and eviction are left to Redis (maxmemory-policy allkeys-lru)."""
+
+    def __init__(self, url: str, prefix: str = "hq:cache:"):
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key: str):
+        raw = await self.client.get(self.prefix + key)
+        return _MISSING if raw is None else json.loads(raw)
+
+    async def set(self, key: str, value: Any, ttl: int, tags: Iterable[str]):
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, json.dumps(value, default=str), ex=ttl)
+        for tag in tags:
+            tag_key = f"{self.prefix}tag:{tag}"
+            pipe.sadd(tag_key, key)
+            pipe.expire(tag_key, ttl)
+        await pipe.execute()
+
+    async def invalidate_tags(self, tags: Iterable[str]):
+        for tag in tags:
+            tag_key = f"{self.prefix}tag:{tag}"
+            keys = await self.client.smembers(tag_key)
+            names = [self.prefix + k.decode() for k in keys] + [tag_key]
+            await self.client.delete(*names)
+
+    async def clear(self):
+        async for name in self.client.scan_iter(match=self.prefix + "*"):
+            await self.client.delete(name)
+
+    def size(self):
+        return None
+
+
+class ResponseCache:
+    def __init__(self, backend, default_ttl: int = 60, enabled: bool = True):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.invalidations = 0
+
+    async def get_or_set(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: int = None, tags: Iterable[str] = ()):
+        """Returns the cached value for key, calling loader and storing its result on a miss."""
+        if not self.enabled:
+            return await loader()
+        try:
+            value = await self.backend.get(key)
+        except Exception as e:
+            # A broken cache must never take the endpoint down with it
+            self.errors += 1
+            logger.warning(f"Cache get failed for {key}: {e}")
+            return await loader()
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await loader()
+        try:
+            await self.backend.set(key, value, ttl or self.default_ttl, tags)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Cache set failed for {key}: {e}")
+        return value
+
+    async def invalidate(self, *tags: str):
+        if not self.enabled:
+            return
+        self.invalidations += 1
+        try:
+            await self.backend.invalidate_tags(tags)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Cache invalidation failed for {tags}: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "enabled": self.enabled,
+            "entries": self.backend.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "errors": self.errors,
+            "invalidations": self.invalidations,
+        }
+
+
+def _from_env() -> ResponseCache:
+    kind = os.getenv("CACHE_BACKEND", "memory").lower()
+    ttl = int(os.getenv("CACHE_TTL", "60"))
+    enabled = kind != "off"
+    if kind == "redis":
+        backend = RedisBackend(os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"))
+    else:
+        backend = MemoryBackend(max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "2048")))
+    return ResponseCache(backend, default_ttl=ttl, enabled=enabled)
+
+
+response_cache = _from_env()
@@ -0,0 +1,104 @@
+"""
+Maintenance of the `conversations` inbox summary table and the per-user
+`unread_counters` totals.
+
+Each pair of users has one row keyed by (user_a_id, user_b_id) with
+user_a_id < user_b_id. The helpers here only stage changes on the given
+session; the caller commits them together with the message write so the
+summary never drifts from the messages table.
+"""
+from sqlalchemy import case, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+import models
+
+PREVIEW_LENGTH = 100
+
+
+def pair_key(user_id: int, other_id: int):
+    return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
+
+
+def _pair_query(user_a_id: int, user_b_id: int):
+    return select(models.Conversation).where(
+        models.Conversation.user_a_id == user_a_id,
+        models.Conversation.user_b_id == user_b_id
+    )
+
+
+async def _get_or_create(db: AsyncSession, user_id: int, other_id: int) -> models.Conversation:
+    user_a_id, user_b_id = pair_key(user_id, other_id)
+    conv = await db.scalar(_pair_query(user_a_id, user_b_id))
+    if conv:
+        return conv
+    try:
+        # Savepoint so a concurrent insert of the same pair doesn't roll back the message
+        async with db.begin_nested():
+            conv = models.Conversation(user_a_id=user_a_id, user_b_id=user_b_id, unread_a=0, unread_b=0)
+            db.add(conv)
+        return conv
+    except IntegrityError:
+        return (await db.scalars(_pair_query(user_a_id, user_b_id))).one()
+
+
+async def _add_unread(db: AsyncSession, user_id: int):
+    counter = models.UnreadCounter
+    increment = update(counter).where(counter.user_id == user_id).values(unread=counter.unread + 1)
+    if (await db.execute(increment)).rowcount:
+        return
+    try:
+        async with db.begin_nested():
+            db.add(counter(user_id=user_id, unread=1))
+    except IntegrityError:
+        # Created by a concurrent send meanwhile
+        await db.execute(increment)
+
+
+async def record_message(db: AsyncSession, msg: models.Message, count_unread: bool = True) -> models.Conversation:
+    """
+    Updates the pair summary for a freshly added (and flushed) message.
+    count_unread=False leaves the receiver's counters alone (they blocked the sender).
+    """
+    conv = await _get_or_create(db, msg.sender_id, msg.receiver_id)
+    conv.last_message_id = msg.id
+    conv.last_message_preview = (msg.content or "")[:PREVIEW_LENGTH]
+    conv.last_message_at = msg.created_at
+    if not count_unread:
+        return conv
+    # Increment in SQL so concurrent sends don't lose updates
+    if msg.receiver_id == conv.user_a_id:
+        conv.unread_a = models.Conversation.unread_a + 1
+    else:
+        conv.unread_b = models.Conversation.unread_b + 1
+    await _add_unread(db, msg.receiver_id)
+    return conv
+
+
+async def mark_read(db: AsyncSession, reader_id: int, partner_id: int):
+    """Clears the reader's unread counter for the conversation with partner_id and takes it off their total."""
+    user_a_id, user_b_id = pair_key(reader_id, partner_id)
+    column = "unread_a" if reader_id == user_a_id else "unread_b"
+    pair = (models.Conversation.user_a_id == user_a_id, models.Conversation.user_b_id == user_b_id)
+    # Row lock (PostgreSQL) so a send committing between the read and the reset isn't lost from the total
+    unread = await db.scalar(select(getattr(models.Conversation, column)).where(*pair).with_for_update())
+    if not unread:
+        return
+    await db.execute(
+        update(models.Conversation).where(*pair).values({column: 0}).execution_options(synchronize_session=False)
+    )
+    counter = models.UnreadCounter
+    await db.execute(update(counter).where(counter.user_id == reader_id).values(
+        unread=case((counter.unread > unread, counter.unread - unread), else_=0)
+    ))
+
+
+async def unread_total(db: AsyncSession, user_id: int) -> int:
+    return await db.scalar(select(models.UnreadCounter.unread).where(models.UnreadCounter.user_id == user_id)) or 0
+
+
+def unread_for(conv: models.Conversation, user_id: int) -> int:
+    return (conv.unread_a if user_id == conv.user_a_id else conv.unread_b) or 0
+
+
+def partner_of(conv: models.Conversation, user_id: int) -> int:
+    return conv.user_b_id if user_id == conv.user_a_id else conv.user_a_id
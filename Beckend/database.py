@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -8,27 +9,98 @@ load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Connection pool settings (per engine, per process)
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+# SQLite tuning: WAL lets the API and both bots read while one of them writes
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+def _pool_kwargs():
+    return {
+        "pool_size": POOL_SIZE,
+        "max_overflow": MAX_OVERFLOW,
+        "pool_timeout": POOL_TIMEOUT,
+        "pool_recycle": POOL_RECYCLE,
+        "pool_pre_ping": POOL_PRE_PING,
+    }
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+def _sqlite_engine():
+    sqlite_engine = create_engine("sqlite:///./megastroy.db", connect_args={"check_same_thread": False}, **_pool_kwargs())
+    event.listen(sqlite_engine, "connect", _set_sqlite_pragmas)
+    return sqlite_engine
+
 try:
     if SQLALCHEMY_DATABASE_URL and "postgresql" in SQLALCHEMY_DATABASE_URL:
         # Check if we can actually connect to Postgres
-        engine = create_engine(SQLALCHEMY_DATABASE_URL)
-        engine.connect()
+        engine = create_engine(SQLALCHEMY_DATABASE_URL, **_pool_kwargs())
+        with engine.connect():
+            pass
     else:
         # If no URL or not postgres, use SQLite
         SQLALCHEMY_DATABASE_URL = "sqlite:///./megastroy.db"
-        engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+        engine = _sqlite_engine()
 except Exception as e:
     print(f"Baza ulanishida xatolik: {e}. SQLite ishlatilmoqda...")
     SQLALCHEMY_DATABASE_URL = "sqlite:///./megastroy.db"
-    engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+    engine = _sqlite_engine()
 
+# Synchronous sessions: bots, migrations and one-off scripts
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def to_async_url(url: str) -> str:
+    """Maps a sync database URL to its async driver (aiosqlite / asyncpg)."""
+    scheme, rest = url.split("://", 1)
+    if scheme.startswith("sqlite"):
+        return f"sqlite+aiosqlite://{rest}"
+    if scheme.startswith("postgresql"):
+        return f"postgresql+asyncpg://{rest}"
+    return url
+
+ASYNC_DATABASE_URL = to_async_url(SQLALCHEMY_DATABASE_URL)
+
+# Asynchronous sessions: the API, so queries don't block the event loop
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_pool_kwargs())
+if ASYNC_DATABASE_URL.startswith("sqlite"):
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
+# expire_on_commit=False: attributes stay readable after commit without an implicit (sync) refresh
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+def _pool_stats(pool):
+    stats = {"class": type(pool).__name__}
+    # QueuePool exposes live counters; other pool classes only describe themselves
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        counter = getattr(pool, name, None)
+        if callable(counter):
+            stats[name] = counter()
+    return stats
+
+def pool_status():
+    """Connection pool counters for the sync and async engines."""
+    return {
+        "database": engine.dialect.name,
+        "sync": _pool_stats(engine.pool),
+        "async": _pool_stats(async_engine.sync_engine.pool),
+        "settings": _pool_kwargs(),
+    }
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,126 @@
+"""
+Process pool for CPU-heavy image work (decode, resize, watermark, encode).
+
+PIL resizing and JPEG encoding hold the GIL long enough that a thread pool
+serializes uploads on one core. The engine runs them in IMAGE_WORKERS
+processes instead. At most IMAGE_WORKERS + IMAGE_QUEUE_SIZE jobs may be
+in flight; beyond that run() raises ImageEngineBusy straight away, and the
+API turns it into 503 + Retry-After rather than letting requests pile up.
+
+A worker that dies (OOM kill, crash in a native decoder) breaks the whole
+pool; the jobs it took down fail, and the next run() starts a fresh pool.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+class ImageEngineBusy(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Image engine queue is full")
+        self.retry_after = retry_after
+
+
+def _timed(fn, *args):
+    """Runs in the worker process; reports pure processing time alongside the result."""
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+class StageTimings:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+class ImageEngine:
+    def __init__(self, workers: int, queue_size: int, retry_after: int):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.rejected = 0
+        self.pool_restarts = 0
+        self.timings = {}  # stage -> StageTimings
+        self._pool = None
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn: workers must not inherit the event loop, DB connections or client sessions
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def record(self, stage: str, seconds: float):
+        self.timings.setdefault(stage, StageTimings()).add(seconds)
+
+    async def run(self, stage: str, fn, *args):
+        """Runs fn(*args) in the pool; fn and args must be picklable."""
+        if self.in_flight >= self.capacity:
+            self.rejected += 1
+            raise ImageEngineBusy(self.retry_after)
+        self.in_flight += 1
+        started = time.perf_counter()
+        pool = self._executor()
+        try:
+            loop = asyncio.get_running_loop()
+            result, work_seconds = await loop.run_in_executor(pool, _timed, fn, *args)
+        except BrokenProcessPool:
+            # Every job in flight on the dead pool lands here; only the first one replaces it
+            if self._pool is pool:
+                self.pool_restarts += 1
+                logger.error(f"Image worker died during {stage}, restarting the pool")
+                self._pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            self.in_flight -= 1
+        self.record(stage, work_seconds)
+        self.record(f"{stage}_wait", time.perf_counter() - started - work_seconds)
+        return result
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "rejected": self.rejected,
+            "pool_restarts": self.pool_restarts,
+            "stages": {stage: t.as_dict() for stage, t in self.timings.items()},
+        }
+
+
+_workers = int(os.getenv("IMAGE_WORKERS", "0")) or os.cpu_count() or 1
+
+image_engine = ImageEngine(
+    workers=_workers,
+    queue_size=int(os.getenv("IMAGE_QUEUE_SIZE", str(_workers * 4))),
+    retry_after=int(os.getenv("IMAGE_RETRY_AFTER", "5")),
+)
@@ -0,0 +1,247 @@
+"""
+Background processing of portfolio images.
+
+POST /profile/portfolio only validates and spools the files, then creates
+the item with processing_state "processing" and one image_jobs row per
+file. Worker coroutines claim jobs from the table, run them through
+image_utils.upload_image_variants and, once every job of an item has
+finished, fill in image_url1..5 and flip the item to "ready" (or "failed"
+when no image could be stored). The owner's own `status` field is never
+touched, and image edits are refused until the item has left "processing".
+
+Jobs survive restarts: the source file stays in IMAGE_JOB_DIR and the row
+stays pending. A claim is an atomic conditional UPDATE with a lease, so
+several API processes can share the table, and jobs whose worker died are
+picked up again once the lease runs out. Failures are retried with
+exponential backoff up to IMAGE_JOB_MAX_ATTEMPTS.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, or_, select, update
+from dotenv import load_dotenv
+
+import models
+import cache
+import image_utils
+from database import AsyncSessionLocal
+from image_engine import ImageEngineBusy
+from image_pipeline import InvalidImage
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# PortfolioItem.processing_state values
+ITEM_PROCESSING = "processing"
+ITEM_READY = "ready"
+ITEM_FAILED = "failed"
+
+IMAGE_JOB_DIR = os.getenv("IMAGE_JOB_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "upload_jobs")
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except (FileNotFoundError, TypeError):
+        pass
+
+
+class ImageJobQueue:
+    def __init__(self, workers: int, max_attempts: int, retry_base: float, lease: float, poll_interval: float):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+
+    def notify(self):
+        """Wakes idle workers after new jobs were committed."""
+        self._wakeup.set()
+
+    def _claimable(self, now):
+        job = models.ImageJob
+        return or_(
+            and_(job.status == PENDING, job.run_after <= now),
+            # Worker died mid-job (crash, redeploy): take it over once its lease has expired
+            and_(job.status == RUNNING, job.locked_until < now),
+        )
+
+    async def _claim(self):
+        job = models.ImageJob
+        async with AsyncSessionLocal() as db:
+            while True:
+                now = datetime.utcnow()
+                candidate = await db.scalar(select(job.id).where(self._claimable(now)).order_by(job.id).limit(1))
+                if candidate is None:
+                    return None
+                claimed = await db.execute(
+                    update(job).where(job.id == candidate, self._claimable(now)).values(
+                        status=RUNNING,
+                        locked_until=now + timedelta(seconds=self.lease),
+                        attempts=job.attempts + 1,
+                        updated_at=now,
+                    )
+                )
+                await db.commit()
+                # Another worker may have claimed the same row between the SELECT and the UPDATE
+                if claimed.rowcount == 1:
+                    return await db.get(job, candidate)
+
+    async def _reschedule(self, job_id, delay, error, count_attempt=True):
+        values = {
+            "status": PENDING,
+            "run_after": datetime.utcnow() + timedelta(seconds=delay),
+            "locked_until": None,
+            "last_error": error,
+            "updated_at": datetime.utcnow(),
+        }
+        if not count_attempt:
+            values["attempts"] = models.ImageJob.attempts - 1
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(models.ImageJob).where(models.ImageJob.id == job_id).values(**values))
+            await db.commit()
+
+    async def _fail(self, job, error, retry=True):
+        if retry and job.attempts < self.max_attempts:
+            self.retried += 1
+            delay = min(self.retry_base * 2 ** (job.attempts - 1), 3600)
+            logger.warning(f"Image job {job.id} failed (attempt {job.attempts}), retrying in {delay:.0f}s: {error}")
+            await self._reschedule(job.id, delay, error)
+            return
+        self.failed += 1
+        logger.error(f"Image job {job.id} gave up after {job.attempts} attempts: {error}")
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(models.ImageJob).where(models.ImageJob.id == job.id).values(
+                status=FAILED, locked_until=None, last_error=error, updated_at=datetime.utcnow()
+            ))
+            await db.commit()
+        _remove(job.source_path)
+        await self._finalize(job.item_id)
+
+    async def _complete(self, job, url, variants):
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(update(models.ImageJob).where(models.ImageJob.id == job.id).values(
+                status=DONE, url=url, variants=variants or None, locked_until=None, last_error=None, updated_at=datetime.utcnow()
+            ))
+            await db.commit()
+        _remove(job.source_path)
+        if result.rowcount == 0:
+            # The item (and its jobs) was deleted while we were uploading
+            await image_utils.release_image(url)
+            return
+        self.completed += 1
+        await self._finalize(job.item_id)
+
+    async def _finalize(self, item_id):
+        """Publishes the item once none of its jobs is pending or running. Safe to run twice."""
+        job = models.ImageJob
+        async with AsyncSessionLocal() as db:
+            jobs = (await db.scalars(select(job).where(job.item_id == item_id).order_by(job.slot))).all()
+            if any(j.status in (PENDING, RUNNING) for j in jobs):
+                return
+            item = await db.get(models.PortfolioItem, item_id)
+            # Already finalized: from here on the image URLs belong to the owner's edits
+            if item is None or item.processing_state != ITEM_PROCESSING:
+                return
+            done = [j for j in jobs if j.status == DONE]
+            urls = [j.url for j in done] + [None] * (5 - len(done))
+            item.image_url1, item.image_url2, item.image_url3, item.image_url4, item.image_url5 = urls[:5]
+            item.image_variants = [j.variants for j in done] or None
+            item.processing_state = ITEM_READY if done else ITEM_FAILED
+            user_id = await db.scalar(select(models.Profile.user_id).where(models.Profile.id == item.profile_id))
+            await db.commit()
+        await cache.response_cache.invalidate("items", f"portfolio:{user_id}")
+        logger.info(f"Portfolio item {item_id} is {item.processing_state} ({len(done)}/{len(jobs)} images)")
+
+    async def _run(self, job):
+        try:
+            uploaded = await image_utils.upload_image_variants(job.source_path, job.file_name)
+        except ImageEngineBusy as e:
+            # Not the job's fault: try again shortly without using up an attempt
+            await self._reschedule(job.id, e.retry_after, "image engine busy", count_attempt=False)
+            return
+        except InvalidImage as e:
+            # Not an image we can decode: retrying would fail the same way
+            await self._fail(job, f"invalid image: {e}", retry=False)
+            return
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back instead of waiting for the lease to expire
+            await asyncio.shield(self._reschedule(job.id, 0, "interrupted by shutdown", count_attempt=False))
+            raise
+        except Exception as e:
+            await self._fail(job, str(e))
+            return
+        if not uploaded:
+            await self._fail(job, "upload failed")
+            return
+        await self._complete(job, *uploaded)
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Image job claim failed: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Image job {job.id} crashed: {e}", exc_info=True)
+
+    def start(self):
+        if not self._tasks:
+            os.makedirs(IMAGE_JOB_DIR, exist_ok=True)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def discard(self, db, item_id):
+        """Drops an item's jobs and their source files; call in the transaction that deletes the item."""
+        paths = (await db.scalars(select(models.ImageJob.source_path).where(models.ImageJob.item_id == item_id))).all()
+        await db.execute(delete(models.ImageJob).where(models.ImageJob.item_id == item_id))
+        for path in paths:
+            _remove(path)
+
+    def stats(self):
+        return {
+            "workers": len(self._tasks),
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "max_attempts": self.max_attempts,
+        }
+
+
+image_jobs = ImageJobQueue(
+    workers=int(os.getenv("IMAGE_JOB_WORKERS", "2")),
+    max_attempts=int(os.getenv("IMAGE_JOB_MAX_ATTEMPTS", "5")),
+    retry_base=float(os.getenv("IMAGE_JOB_RETRY_BASE", "10")),
+    lease=float(os.getenv("IMAGE_JOB_LEASE", "600")),
+    poll_interval=float(os.getenv("IMAGE_JOB_POLL_INTERVAL", "5")),
+)
@@ -0,0 +1,171 @@
+"""
+CPU-side image transforms, run inside the image engine's worker processes.
+
+Kept free of database / ImageKit imports so spawned workers only load PIL.
+"""
+import os
+import io
+import math
+import functools
+import logging
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+def _open_source(source):
+    """Opens raw bytes or a path to a spooled upload; PIL reads files lazily without an extra copy."""
+    if isinstance(source, (bytes, bytearray)):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
+
+class InvalidImage(Exception):
+    """The upload is not an image this pipeline can decode; the API answers 422."""
+
+
+class UnsupportedImage(InvalidImage):
+    """PIL does not recognise the format at all (e.g. HEIC without a plugin); the API answers 415."""
+
+MAX_DIMENSION = 4000
+LOGO_PATH = os.path.join(os.path.dirname(__file__), "logo.png")
+WATERMARK_BUCKET_PX = int(os.getenv("WATERMARK_BUCKET_PX", "16"))
+WATERMARK_CACHE_SIZE = int(os.getenv("WATERMARK_CACHE_SIZE", "64"))
+
+# Responsive variants, largest first: name -> longest side in px
+VARIANT_SIZES = {"full": 1600, "card": 800, "thumb": 320}
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "80"))
+
+# --- Transform pipeline: decode -> orient -> downscale -> watermark -> encode ---
+# Each stage takes and returns a PIL image, so the upload is decoded exactly once
+# and lossy-encoded exactly once, whatever combination of stages runs.
+
+def decode(source, max_size=MAX_DIMENSION):
+    """
+    Opens the image and, for JPEGs, asks libjpeg to scale by 1/2, 1/4 or 1/8
+    while decoding (DCT-domain), so a 6000px photo never exists in memory at
+    full size when only 4000px is kept.
+    """
+    img = _open_source(source)
+    if img.format == "JPEG" and max_size and max(img.size) > max_size:
+        # draft() only picks a scale that keeps both sides >= the requested size,
+        # so ask for the aspect-preserving target rather than a square box
+        ratio = max_size / max(img.size)
+        img.draft("RGB", (math.ceil(img.width * ratio), math.ceil(img.height * ratio)))
+    img.load()
+    return img
+
+def _prepare(source, max_size):
+    """decode + orient + to_rgb, turning a bad upload into InvalidImage instead of a server error."""
+    try:
+        img = decode(source, max_size)
+        return to_rgb(orient(img))
+    except Image.UnidentifiedImageError as e:
+        raise UnsupportedImage(str(e))
+    except Exception as e:
+        # Truncated or corrupt data, decompression bombs, broken EXIF
+        raise InvalidImage(f"{type(e).__name__}: {e}")
+
+def orient(img):
+    """Applies the EXIF orientation tag, since the encoded JPEG drops EXIF."""
+    return ImageOps.exif_transpose(img)
+
+def to_rgb(img):
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img
+
+def downscale(img, max_size=MAX_DIMENSION):
+    if img.width > max_size or img.height > max_size:
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    return img
+
+@functools.lru_cache(maxsize=1)
+def _logo():
+    """logo.png decoded once per process (each image worker keeps its own copy)."""
+    if not os.path.exists(LOGO_PATH):
+        logger.warning(f"Logo not found at {LOGO_PATH}, skipping watermark.")
+        return None
+    with Image.open(LOGO_PATH) as logo:
+        return logo.convert("RGBA")
+
+@functools.lru_cache(maxsize=WATERMARK_CACHE_SIZE)
+def _scaled_logo(width):
+    """
+    The logo resized to `width`, as (rgb, mask). Resampling happens on
+    premultiplied RGBa so transparent edges don't bleed dark fringes; the
+    result is split once so paste() needs no per-image conversion, and an
+    opaque logo gets no mask at all (a plain copy).
+    """
+    logo = _logo()
+    height = max(1, round(logo.height * width / logo.width))
+    scaled = logo.convert("RGBa").resize((width, height), Image.Resampling.LANCZOS).convert("RGBA")
+    alpha = scaled.getchannel("A")
+    mask = None if alpha.getextrema() == (255, 255) else alpha
+    return scaled.convert("RGB"), mask
+
+def watermark(img):
+    """Pastes logo.png at ~15% of the image width, bottom right with 20px padding."""
+    if _logo() is None:
+        return img
+    # Widths are bucketed so a handful of cached sizes serve every upload
+    target_width = int(img.width * 0.15)
+    bucket = max(WATERMARK_BUCKET_PX, round(target_width / WATERMARK_BUCKET_PX) * WATERMARK_BUCKET_PX)
+    logo, mask = _scaled_logo(bucket)
+
+    padding = 20
+    position = (img.width - logo.width - padding, img.height - logo.height - padding)
+    img.paste(logo, position, mask)
+    return img
+
+def encode(img, quality=85):
+    output = io.BytesIO()
+    img.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+def encode_webp(img, quality=WEBP_QUALITY):
+    output = io.BytesIO()
+    # method 4 of 0-6: most of the size win of 6 at about half the encode time
+    img.save(output, format="WEBP", quality=quality, method=4)
+    return output.getvalue()
+
+def process_image(source, apply_logo=False, max_size=MAX_DIMENSION, quality=85):
+    """
+    Runs the whole pipeline on one upload and returns JPEG bytes.
+    source may be raw bytes or a path to a spooled upload. Raises
+    InvalidImage (or UnsupportedImage) when it cannot be decoded; the raw
+    bytes are never stored in place of an image.
+    """
+    img = downscale(_prepare(source, max_size), max_size)
+    if apply_logo:
+        img = watermark(img)
+    return encode(img, quality)
+
+def process_image_variants(source, apply_logo=False, max_size=MAX_DIMENSION, quality=85):
+    """
+    Same single decode as process_image, plus the VARIANT_SIZES renditions in
+    WebP and JPEG. Each variant is resized from the previous (already smaller)
+    one, so the chain costs little more than the original alone.
+
+    Returns {"original": jpeg, "variants": {name: {"webp": bytes, "jpeg": bytes}}};
+    raises InvalidImage like process_image.
+    """
+    img = downscale(_prepare(source, max_size), max_size)
+    if apply_logo:
+        img = watermark(img)
+    result = {"original": encode(img, quality), "variants": {}}
+    for name, size in VARIANT_SIZES.items():
+        if max(img.size) > size:
+            img = img.copy()
+            img.thumbnail((size, size), Image.Resampling.LANCZOS)
+        result["variants"][name] = {"webp": encode_webp(img), "jpeg": encode(img, quality)}
+    return result
+
+def compress_image(file_content, quality=85):
+    """Compresses image to JPEG (max 4000px). Kept for callers of the old API."""
+    return process_image(file_content, quality=quality)
+
+def apply_watermark(file_content):
+    """Compresses and watermarks in one decode/encode. Kept for callers of the old API."""
+    return process_image(file_content, apply_logo=True)
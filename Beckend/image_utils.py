@@ -1,129 +1,241 @@
 import os
-import io
-from imagekitio import AsyncImageKit
-from dotenv import load_dotenv
-from PIL import Image
+import asyncio
+import hashlib
 import logging
-import anyio
+import time
+from dotenv import load_dotenv
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+import models
+from database import AsyncSessionLocal
+from image_engine import image_engine, ImageEngineBusy
+from storage import storage
+from image_pipeline import process_image, process_image_variants, InvalidImage, MAX_DIMENSION, VARIANT_SIZES
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-imagekit = AsyncImageKit(
-    private_key=os.getenv("IMAGEKIT_PRIVATE_KEY"),
-    timeout=300.0,
-    max_retries=0
-)
+# Bump when the pipeline output changes, so old entries stop matching new uploads
+TRANSFORM_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+
+dedup_stats = {"hits": 0, "misses": 0, "released": 0, "deleted": 0}
+
+# --- Content-addressed dedup: sha256(transform params + raw bytes) -> hosted file ---
+
+def _transform_key(folder, apply_logo, with_variants=False):
+    key = f"v{TRANSFORM_VERSION}|max={MAX_DIMENSION}|logo={int(bool(apply_logo))}|folder={folder}"
+    if with_variants:
+        key += "|variants=" + ",".join(f"{name}:{size}" for name, size in VARIANT_SIZES.items())
+    return key
+
+def content_hash(source, transform_key):
+    """Hashes raw bytes or a spooled upload file in chunks, prefixed with the transform parameters."""
+    digest = hashlib.sha256(transform_key.encode())
+    digest.update(b"\0")
+    if isinstance(source, (bytes, bytearray)):
+        digest.update(source)
+    else:
+        with open(source, "rb") as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def variant_urls(stored):
+    """{name: {format: {"url", "file_id"}}} as kept in image_assets -> {name: {format: url}} for clients."""
+    return {name: {fmt: f["url"] for fmt, f in formats.items()} for name, formats in (stored or {}).items()}
+
+def _file_ids(file_id, stored):
+    # A set: with content-addressed storage a small image's thumb JPEG can be the original's file
+    return {file_id} | {f["file_id"] for formats in (stored or {}).values() for f in formats.values()}
+
+async def _referenced_elsewhere(db, file_id):
+    """Content-addressed backends can give different assets the same file (e.g. an avatar also posted in a listing)."""
+    files = models.ImageAssetFile
+    return await db.scalar(select(files.id).where(files.file_id == file_id).limit(1)) is not None
 
-def compress_image(file_content, quality=85):
+async def _acquire(content_hash):
+    """Takes a reference on an already hosted file; returns (url, variants), or None when unknown."""
+    asset = models.ImageAsset
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            update(asset).where(asset.content_hash == content_hash).values(ref_count=asset.ref_count + 1)
+        )
+        if result.rowcount == 0:
+            return None
+        row = (await db.execute(select(asset.url, asset.variants).where(asset.content_hash == content_hash))).first()
+        await db.commit()
+        return row.url, variant_urls(row.variants)
+
+async def _register(content_hash, url, file_id, size_bytes, stored):
+    async with AsyncSessionLocal() as db:
+        asset = models.ImageAsset(
+            content_hash=content_hash, url=url, file_id=file_id, ref_count=1, size_bytes=size_bytes, variants=stored or None
+        )
+        db.add(asset)
+        try:
+            await db.flush()
+            db.add_all([models.ImageAssetFile(asset_id=asset.id, file_id=f) for f in _file_ids(file_id, stored) if f])
+            await db.commit()
+            return url, variant_urls(stored)
+        except IntegrityError:
+            await db.rollback()
+    # The same bytes were uploaded concurrently and registered first: share those files, drop ours
+    existing = await _acquire(content_hash)
+    if existing is None:
+        return url, variant_urls(stored)
+    for orphan in _file_ids(file_id, stored):
+        await _delete_file(orphan)
+    return existing
+
+async def _release(condition):
     """
-    Compresses image to JPEG with higher quality as requested.
-    Allows ImageKit to handle further optimization.
+    Drops one reference. The hosted files are deleted when the last one goes.
+    Returns False if the file is not in the index (uploaded before dedup).
     """
+    asset = models.ImageAsset
+    async with AsyncSessionLocal() as db:
+        # Content-addressed storage can give two assets the same URL; drop exactly one reference
+        asset_id = await db.scalar(select(asset.id).where(condition, asset.ref_count > 0).order_by(asset.id).limit(1))
+        if asset_id is None:
+            return False
+        await db.execute(update(asset).where(asset.id == asset_id).values(ref_count=asset.ref_count - 1))
+        row = (await db.execute(select(asset.id, asset.file_id, asset.variants, asset.ref_count).where(asset.id == asset_id))).first()
+        orphans = []
+        if row.ref_count <= 0:
+            # Guarded on ref_count so an upload that re-acquired it meanwhile keeps the file
+            deleted = await db.execute(delete(asset).where(asset.id == row.id, asset.ref_count <= 0))
+            if deleted.rowcount == 1:
+                await db.execute(delete(models.ImageAssetFile).where(models.ImageAssetFile.asset_id == row.id))
+                orphans = [f for f in _file_ids(row.file_id, row.variants) if f and not await _referenced_elsewhere(db, f)]
+        await db.commit()
+    dedup_stats["released"] += 1
+    if orphans:
+        dedup_stats["deleted"] += 1
+        for file_id in orphans:
+            await _delete_file(file_id)
+    return True
+
+async def release_image(url):
+    """Call when a row stops using an uploaded image URL (item deleted, avatar replaced, ...)."""
+    if not url:
+        return
     try:
-        img = Image.open(io.BytesIO(file_content))
-        if img.mode in ("RGBA", "P"):
-            img = img.convert("RGB")
-        
-        # Increased max dimensions to 4000px for high quality
-        if img.width > 4000 or img.height > 4000:
-            img.thumbnail((4000, 4000), Image.Resampling.LANCZOS)
-            
-        output = io.BytesIO()
-        img.save(output, format="JPEG", quality=quality, optimize=True)
-        return output.getvalue()
+        await _release(models.ImageAsset.url == url)
     except Exception as e:
-        logger.error(f"Compression error: {e}")
-        return file_content
+        logger.error(f"Image release error for {url}: {e}")
 
-def apply_watermark(file_content):
-    """
-    Applies logo.png as a watermark to the bottom-right corner of the image.
-    """
+# --- Upload ---
+
+async def _put(content, file_name, folder):
+    """Stores one file with the configured backend; returns (url, file_id)."""
+    logger.info(f"Starting {storage.name} upload for {file_name} (Size: {len(content) / 1024:.2f} KB)...")
+    started = time.perf_counter()
+    url, file_id = await storage.put(content, file_name, folder)
+    image_engine.record("upload", time.perf_counter() - started)
+    logger.info(f"{storage.name} upload successful for {file_name}: {url}")
+    return url, file_id
+
+def _variant_file_name(file_name, name, fmt):
+    stem = os.path.splitext(file_name or "image")[0]
+    return f"{stem}_{name}.{'webp' if fmt == 'webp' else 'jpg'}"
+
+async def _upload(file_content, file_name, folder, apply_logo, with_variants):
+    """Processes and uploads one image; returns (url, variants) or None."""
     try:
-        # Load the uploaded image
-        img = Image.open(io.BytesIO(file_content))
-        
-        # Ensure it's in RGBA for transparency support during pasting if needed
-        if img.mode != 'RGBA':
-            img = img.convert('RGBA')
-            
-        # Keep original size unless it's excessively large (safety measure)
-        if img.width > 4000 or img.height > 4000:
-            img.thumbnail((4000, 4000), Image.Resampling.LANCZOS)
-            
-        # Load logo
-        logo_path = os.path.join(os.path.dirname(__file__), "logo.png")
-        if not os.path.exists(logo_path):
-            print(f"Logo not found at {logo_path}, skipping watermark.")
-            # Still save with lower quality to compress
-            output = io.BytesIO()
-            img = img.convert('RGB')
-            img.save(output, format="JPEG", quality=70, optimize=True)
-            return output.getvalue()
-            
-        logo = Image.open(logo_path)
-        
-        # Resize logo to be roughly 15% of the image width
-        target_width = int(img.width * 0.15)
-        w_percent = (target_width / float(logo.size[0]))
-        target_height = int((float(logo.size[1]) * float(w_percent)))
-        logo = logo.resize((target_width, target_height), Image.Resampling.LANCZOS)
-        
-        # Position: Bottom Right with 20px padding
-        padding = 20
-        position = (img.width - logo.width - padding, img.height - logo.height - padding)
-        
-        # Paste logo (use logo as its own mask if it has transparency)
-        img.paste(logo, position, logo if 'A' in logo.getbands() else None)
-        
-        # Convert back to RGB for saving (JPEG doesn't support transparency)
-        img = img.convert('RGB')
-        
-        # Save to buffer with optimized settings
-        output = io.BytesIO()
-        img.save(output, format="JPEG", quality=75, optimize=True, subsampling=0)
-        return output.getvalue()
-        
+        # Same photo re-posted: reuse the hosted files, skipping processing and upload entirely
+        digest = await asyncio.to_thread(content_hash, file_content, _transform_key(folder, apply_logo, with_variants))
+        try:
+            existing = await _acquire(digest)
+        except Exception as e:
+            # The index is an optimisation; without it we just upload as before
+            logger.error(f"Image dedup lookup error: {e}")
+            existing, digest = None, None
+        if existing:
+            dedup_stats["hits"] += 1
+            logger.info(f"Reusing hosted image for {file_name}: {existing[0]}")
+            return existing
+        dedup_stats["misses"] += 1
+
+        # One decode per upload; the watermark and every variant come from that single image.
+        # CPU-bound work runs in the image engine's process pool, off the event loop and the GIL
+        if with_variants:
+            processed = await image_engine.run("process", process_image_variants, file_content, apply_logo)
+        else:
+            processed = {"original": await image_engine.run("process", process_image, file_content, apply_logo), "variants": {}}
+
+        renditions = [(name, fmt, data) for name, formats in processed["variants"].items() for fmt, data in formats.items()]
+        results = await asyncio.gather(
+            _put(processed["original"], file_name, folder),
+            *[_put(data, _variant_file_name(file_name, name, fmt), folder) for name, fmt, data in renditions],
+            return_exceptions=True
+        )
+        original, uploaded = results[0], results[1:]
+        if isinstance(original, Exception):
+            for result in uploaded:
+                if not isinstance(result, Exception):
+                    await _delete_file(result[1])
+            raise original
+
+        # A failed variant only costs clients the smaller size; they fall back to the original
+        stored = {}
+        for (name, fmt, _), result in zip(renditions, uploaded):
+            if isinstance(result, Exception):
+                logger.error(f"Variant upload error ({name}/{fmt}): {result}")
+                continue
+            stored.setdefault(name, {})[fmt] = {"url": result[0], "file_id": result[1]}
+
+        url, file_id = original
+        if digest is None:
+            return url, variant_urls(stored)
+        try:
+            return await _register(digest, url, file_id, len(processed["original"]), stored)
+        except Exception as e:
+            logger.error(f"Image dedup register error: {e}")
+            return url, variant_urls(stored)
+    except (ImageEngineBusy, InvalidImage):
+        # Saturated or not an image: let the API answer 503 / 415 / 422 instead of a generic failure
+        raise
     except Exception as e:
-        logger.error(f"Watermark error: {e}")
-        return file_content
+        logger.error(f"Image upload error: {e}", exc_info=True)
+        return None
 
 async def upload_image(file_content, file_name, folder="/hamkorqurilish", apply_logo=False):
     """
-    Uploads a file to ImageKit and returns the URL.
+    Uploads a file to the storage backend and returns the URL.
+    file_content may be raw bytes or the path of a SpooledUpload.
+    """
+    uploaded = await _upload(file_content, file_name, folder, apply_logo, with_variants=False)
+    return uploaded[0] if uploaded else None
+
+async def upload_image_variants(file_content, file_name, folder="/hamkorqurilish", apply_logo=False):
     """
+    Like upload_image, but also hosts the thumb/card/full renditions.
+    Returns (url, variants) with variants as {name: {"webp": url, "jpeg": url}},
+    or None if the upload failed.
+    """
+    return await _upload(file_content, file_name, folder, apply_logo, with_variants=True)
+
+async def _delete_file(file_id):
+    if not file_id:
+        return False
     try:
-        # Compress image to optimize upload speed (essential for large PNGs/JPEGs)
-        file_content = await anyio.to_thread.run_sync(compress_image, file_content)
-
-        # Apply watermark if requested
-        if apply_logo:
-            # Run watermark (CPU intensive) in a separate thread to avoid blocking loop
-            file_content = await anyio.to_thread.run_sync(apply_watermark, file_content)
-
-        size_kb = len(file_content) / 1024
-        logger.info(f"Starting ImageKit upload for {file_name} (Size: {size_kb:.2f} KB)...")
-        upload = await imagekit.files.upload(
-            file=file_content,
-            file_name=file_name,
-            folder=folder,
-            use_unique_file_name=True
-        )
-        logger.info(f"ImageKit upload successful for {file_name}: {upload.url}")
-        return upload.url
+        await storage.delete(file_id)
+        return True
     except Exception as e:
-        logger.error(f"ImageKit upload error: {e}", exc_info=True)
-        return None
+        logger.error(f"{storage.name} delete error: {e}")
+        return False
 
 async def delete_image(file_id):
     """
-    Deletes an image from ImageKit.
+    Deletes an image from storage once nothing references it any more.
+    Files that are not in the dedup index are deleted straight away.
     """
     try:
-        await imagekit.files.delete(file_id)
-        return True
+        if await _release(models.ImageAsset.file_id == file_id):
+            return True
     except Exception as e:
-        logger.error(f"ImageKit delete error: {e}")
+        logger.error(f"Image release error for {file_id}: {e}")
         return False
+    return await _delete_file(file_id)
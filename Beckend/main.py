@@ -1,12 +1,19 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Body, Request
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Body, Request, Query, WebSocket
+from fastapi.responses import HTMLResponse, JSONResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy import func # Added func import
-import models, schemas, auth, database, image_utils
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy import func, select, update
+import models, schemas, auth, database, image_utils, image_jobs, migrations, conversations, cache, uploads, realtime, quotas, archive
+from write_behind import view_counter
+from ad_events import ad_events
+from image_engine import image_engine, ImageEngineBusy
+from image_pipeline import InvalidImage, UnsupportedImage
+from storage import storage, LocalStorage
+from contextlib import asynccontextmanager
 from database import engine, get_db
-from typing import List, Optional
+from typing import List, Optional, Union
 import json
 from datetime import datetime, timedelta
 
@@ -22,8 +29,29 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 models.Base.metadata.create_all(bind=engine)
-
-app = FastAPI(title="HamkorQurilish API")
+migrations.run_migrations(engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    view_counter.start()
+    ad_events.start()
+    image_jobs.image_jobs.start()
+    await realtime.hub.start()
+    archive.message_archiver.start()
+    yield
+    await archive.message_archiver.stop()
+    await realtime.hub.stop()
+    # Hand unfinished image jobs back to the queue, then flush buffered writes before the process exits
+    await image_jobs.image_jobs.stop()
+    await view_counter.stop()
+    await ad_events.stop()
+    image_engine.shutdown()
+    await storage.close()
+
+app = FastAPI(title="HamkorQurilish API", lifespan=lifespan)
+
+# Before CORS is added, so CORS wraps it and 413 responses still carry CORS headers
+app.add_middleware(uploads.BodySizeLimitMiddleware)
 
 # CORS configuration - Tighten this in production!
 app.add_middleware(
@@ -42,10 +70,31 @@ app.add_middleware(
 
 app.include_router(admin_ads.router)
 
+@app.exception_handler(ImageEngineBusy)
+async def image_engine_busy_handler(request: Request, exc: ImageEngineBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server band, iltimos birozdan so'ng qayta urinib ko'ring"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.exception_handler(InvalidImage)
+async def invalid_image_handler(request: Request, exc: InvalidImage):
+    if isinstance(exc, UnsupportedImage):
+        return JSONResponse(status_code=415, content={"detail": "Rasm formati qo'llab-quvvatlanmaydi"})
+    return JSONResponse(status_code=422, content={"detail": "Rasmni o'qib bo'lmadi, boshqa fayl yuboring"})
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to HamkorQurilish API"}
 
+@app.get("/media/{path:path}")
+async def get_media(path: str):
+    # Only the local storage backend hosts files itself; ImageKit URLs point at the CDN
+    if not isinstance(storage, LocalStorage):
+        raise HTTPException(status_code=404, detail="Fayl topilmadi")
+    return storage.response(path)
+
 @app.get("/privacy-policy", response_class=HTMLResponse)
 @app.get("/api/privacy-policy", response_class=HTMLResponse)
 async def privacy_policy():
@@ -101,20 +150,23 @@ async def privacy_policy():
     return html_content
 
 @app.post("/auth/login", response_model=schemas.LoginRequest)
-async def login(request: schemas.LoginRequest, db: Session = Depends(get_db)):
+async def login(request: schemas.LoginRequest, db: AsyncSession = Depends(get_db)):
     logger.info(f"Login request received for phone: {request.phone}, role: {request.role}")
     # Check if user exists, if not create them
     request.phone = auth.normalize_phone(request.phone)
-    user = db.query(models.User).filter(models.User.phone == request.phone).first()
+    # Every login sends a Telegram OTP: cap how often one number can trigger it
+    await quotas.engine.enforce(quotas.OTP_REQUESTS, request.phone)
+    user = await db.scalar(select(models.User).where(models.User.phone == request.phone))
     if not user:
         user = models.User(phone=request.phone, role=models.UserRole(request.role))
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
     elif request.role and user.role != models.UserRole(request.role):
         # Allow user to update their role during login (e.g. switching from Supplier to Customer)
         user.role = models.UserRole(request.role)
-        db.commit()
+        await db.commit()
+        auth.invalidate_user(user.phone)
     
     logger.info(f"Integrated OTP sending for {request.phone} with telegram_id: {user.telegram_id}")
     # Generate and send OTP (in database now)
@@ -123,10 +175,10 @@ async def login(request: schemas.LoginRequest, db: Session = Depends(get_db)):
     return request
 
 @app.post("/auth/verify", response_model=schemas.Token)
-async def verify(request: schemas.OTPVerify, db: Session = Depends(get_db)):
+async def verify(request: schemas.OTPVerify, db: AsyncSession = Depends(get_db)):
     logger.info(f"Verify request received for phone: {request.phone}, code: {request.otp_code}")
     request.phone = auth.normalize_phone(request.phone)
-    user = db.query(models.User).filter(models.User.phone == request.phone).first()
+    user = await db.scalar(select(models.User).where(models.User.phone == request.phone))
     
     if not user or not user.otp_code or user.otp_code != request.otp_code:
         raise HTTPException(status_code=400, detail="Noto'g'ri tasdiqlash kodi")
@@ -135,12 +187,12 @@ async def verify(request: schemas.OTPVerify, db: Session = Depends(get_db)):
     if user.otp_created_at and datetime.utcnow() - user.otp_created_at > timedelta(minutes=10):
         # Clear expired OTP
         user.otp_code = None
-        db.commit()
+        await db.commit()
         raise HTTPException(status_code=400, detail="Tasdiqlash kodi muddati o'tgan")
 
     # Clear code after successful verify
     user.otp_code = None
-    db.commit()
+    await db.commit()
     
     access_token = auth.create_access_token(data={"sub": user.phone})
     return {"access_token": access_token, "token_type": "bearer"}
@@ -153,11 +205,15 @@ class RoleUpdate(BaseModel):
     role: schemas.UserRole
 
 @app.put("/users/role", response_model=schemas.User)
-async def update_role(role_data: RoleUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    current_user.role = models.UserRole(role_data.role)
-    db.commit()
-    db.refresh(current_user)
-    return current_user
+async def update_role(role_data: RoleUpdate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    # current_user may be a cached snapshot, so update the row through this session
+    user = await db.get(models.User, current_user.id)
+    user.role = models.UserRole(role_data.role)
+    await db.commit()
+    await db.refresh(user)
+    auth.invalidate_user(user.phone)
+    await cache.response_cache.invalidate(f"profile:{user.id}", "items")
+    return user
 
 # --- Admin Endpoints ---
 
@@ -167,11 +223,11 @@ def check_admin(user: models.User = Depends(auth.get_current_user)):
     return user
 
 @app.get("/admin/stats", dependencies=[Depends(check_admin)])
-async def get_admin_stats(db: Session = Depends(get_db)):
-    users_count = db.query(models.User).count()
-    profiles_count = db.query(models.Profile).count()
-    verified_count = db.query(models.Profile).filter(models.Profile.is_verified == True).count()
-    portfolio_count = db.query(models.PortfolioItem).count()
+async def get_admin_stats(db: AsyncSession = Depends(get_db)):
+    users_count = await db.scalar(select(func.count()).select_from(models.User))
+    profiles_count = await db.scalar(select(func.count()).select_from(models.Profile))
+    verified_count = await db.scalar(select(func.count()).select_from(models.Profile).where(models.Profile.is_verified == True))
+    portfolio_count = await db.scalar(select(func.count()).select_from(models.PortfolioItem))
     
     return {
         "users": users_count,
@@ -181,34 +237,35 @@ async def get_admin_stats(db: Session = Depends(get_db)):
     }
 
 @app.get("/admin/unverified", dependencies=[Depends(check_admin)], response_model=List[schemas.Profile])
-async def get_unverified_profiles(db: Session = Depends(get_db)):
-    return db.query(models.Profile).filter(models.Profile.is_verified == False).all()
+async def get_unverified_profiles(db: AsyncSession = Depends(get_db)):
+    return (await db.scalars(select(models.Profile).where(models.Profile.is_verified == False))).all()
 
 @app.post("/admin/profiles/{profile_id}/verify", dependencies=[Depends(check_admin)])
-async def verify_profile(profile_id: int, db: Session = Depends(get_db)):
-    profile = db.query(models.Profile).filter(models.Profile.id == profile_id).first()
+async def verify_profile(profile_id: int, db: AsyncSession = Depends(get_db)):
+    profile = await db.get(models.Profile, profile_id)
     if not profile:
         raise HTTPException(status_code=404, detail="Profil topilmadi")
     profile.is_verified = True
-    db.commit()
+    await db.commit()
+    await cache.response_cache.invalidate(f"profile:{profile.user_id}", "items")
     return {"message": "Profil tasdiqlandi"}
 
 # --- Profile Endpoints ---
 
 @app.get("/profiles/me", response_model=schemas.Profile)
-async def get_my_profile(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    profile = db.query(models.Profile).filter(models.Profile.user_id == current_user.id).first()
+async def get_my_profile(db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    profile = await db.scalar(select(models.Profile).where(models.Profile.user_id == current_user.id))
     if not profile:
         # Auto-create profile if doesn't exist
         profile = models.Profile(user_id=current_user.id)
         db.add(profile)
-        db.commit()
-        db.refresh(profile)
+        await db.commit()
+        await db.refresh(profile)
     return profile
 
 @app.put("/profiles/me", response_model=schemas.Profile)
-async def update_my_profile(profile_data: schemas.ProfileBase, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    profile = db.query(models.Profile).filter(models.Profile.user_id == current_user.id).first()
+async def update_my_profile(profile_data: schemas.ProfileBase, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    profile = await db.scalar(select(models.Profile).where(models.Profile.user_id == current_user.id))
     if not profile:
         profile = models.Profile(user_id=current_user.id)
         db.add(profile)
@@ -216,53 +273,75 @@ async def update_my_profile(profile_data: schemas.ProfileBase, db: Session = Dep
     for key, value in profile_data.dict(exclude_unset=True).items():
         setattr(profile, key, value)
     
-    db.commit()
-    db.refresh(profile)
+    await db.commit()
+    await db.refresh(profile)
+    await cache.response_cache.invalidate(f"profile:{current_user.id}", "items")
     return profile
 
 @app.post("/profiles/me/avatar", response_model=schemas.Profile)
-async def upload_avatar(file: UploadFile = File(...), db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    profile = db.query(models.Profile).filter(models.Profile.user_id == current_user.id).first()
+async def upload_avatar(file: UploadFile = File(...), db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    profile = await db.scalar(select(models.Profile).where(models.Profile.user_id == current_user.id))
     if not profile:
         profile = models.Profile(user_id=current_user.id)
         db.add(profile)
     
-    file_content = await file.read()
-    image_url = image_utils.upload_image(file_content, file.filename)
+    async with await uploads.spool_upload(file) as upload:
+        image_url = await image_utils.upload_image(upload.path, upload.filename)
     
     if not image_url:
         raise HTTPException(status_code=500, detail="Rasmni yuklashda xatolik yuz berdi")
     
+    previous_avatar = profile.avatar_url
     profile.avatar_url = image_url
-    db.commit()
-    db.refresh(profile)
+    await db.commit()
+    await db.refresh(profile)
+    await cache.response_cache.invalidate(f"profile:{current_user.id}", "items")
+    if previous_avatar != image_url:
+        await image_utils.release_image(previous_avatar)
     return profile
 
 # --- Portfolio Endpoints ---
 
+# Listings whose images are still uploading (or never made it) are only shown to their owner
+PUBLIC_ITEM_FILTER = func.coalesce(models.PortfolioItem.processing_state, image_jobs.ITEM_READY).notin_(
+    (image_jobs.ITEM_PROCESSING, image_jobs.ITEM_FAILED)
+)
+
 @app.get("/profiles/me/portfolio", response_model=List[schemas.PortfolioItem])
-async def get_my_portfolio(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    profile = db.query(models.Profile).filter(models.Profile.user_id == current_user.id).first()
+async def get_my_portfolio(db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    profile = await db.scalar(select(models.Profile).where(models.Profile.user_id == current_user.id))
     if not profile:
         profile = models.Profile(user_id=current_user.id)
         db.add(profile)
-        db.commit()
-        db.refresh(profile)
-    return profile.items
+        await db.commit()
+        await db.refresh(profile)
+    return (await db.scalars(select(models.PortfolioItem).where(models.PortfolioItem.profile_id == profile.id))).all()
 
 @app.get("/profiles/{user_id}", response_model=schemas.ProfilePublic)
-async def get_public_profile(user_id: int, db: Session = Depends(get_db)):
-    profile = db.query(models.Profile).filter(models.Profile.user_id == user_id).first()
-    if not profile:
-        raise HTTPException(status_code=404, detail="Profil topilmadi")
-    return profile
+async def get_public_profile(user_id: int, db: AsyncSession = Depends(get_db)):
+    async def load():
+        profile = await db.scalar(
+            select(models.Profile).where(models.Profile.user_id == user_id).options(selectinload(models.Profile.user))
+        )
+        if not profile:
+            raise HTTPException(status_code=404, detail="Profil topilmadi")
+        return schemas.ProfilePublic.model_validate(profile).model_dump(mode="json")
+
+    return await cache.response_cache.get_or_set(f"profile:{user_id}", load, tags=[f"profile:{user_id}"])
 
 @app.get("/profiles/{user_id}/portfolio", response_model=List[schemas.PortfolioItem])
-async def get_user_portfolio(user_id: int, db: Session = Depends(get_db)):
-    profile = db.query(models.Profile).filter(models.Profile.user_id == user_id).first()
-    if not profile:
-        raise HTTPException(status_code=404, detail="Profil topilmadi")
-    return profile.items
+async def get_user_portfolio(user_id: int, db: AsyncSession = Depends(get_db)):
+    async def load():
+        profile = await db.scalar(select(models.Profile).where(models.Profile.user_id == user_id))
+        if not profile:
+            raise HTTPException(status_code=404, detail="Profil topilmadi")
+        items = await db.scalars(select(models.PortfolioItem).where(
+            models.PortfolioItem.profile_id == profile.id,
+            PUBLIC_ITEM_FILTER
+        ))
+        return [schemas.PortfolioItem.model_validate(item).model_dump(mode="json") for item in items]
+
+    return await cache.response_cache.get_or_set(f"portfolio:{user_id}", load, tags=[f"portfolio:{user_id}"])
 
 @app.post("/profile/portfolio", response_model=schemas.PortfolioItem)
 async def upload_portfolio(
@@ -276,41 +355,27 @@ async def upload_portfolio(
     phone: str = Form(""),
     files: List[UploadFile] = File(...),
     current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     logger.info(f"Upload portfolio started for user: {current_user.id}, title: {title}, files_count: {len(files)}")
-    profile = db.query(models.Profile).filter(models.Profile.user_id == current_user.id).first()
+    profile = await db.scalar(select(models.Profile).where(models.Profile.user_id == current_user.id))
     if not profile:
         profile = models.Profile(user_id=current_user.id)
         db.add(profile)
-        db.commit()
-        db.refresh(profile)
-    
-    import asyncio
-    
-    async def process_file(file):
-        content = await file.read()
-        return await image_utils.upload_image(content, file.filename)
-
-    # Limit to 5 images and process in parallel
-    tasks = [process_file(f) for f in files[:5]]
-    image_urls = await asyncio.gather(*tasks)
-    
-    # Filter out None results (failed uploads)
-    image_urls = [url for url in image_urls if url]
-    
-    if not image_urls:
-        logger.error(f"No images uploaded correctly for user {current_user.id}")
-        raise HTTPException(status_code=500, detail="Hech bo'lmaganda bitta rasmni yuklashda xatolik yuz berdi")
-    
-    logger.info(f"Successfully uploaded {len(image_urls)} images for user {current_user.id}")
-    
-    # Pad images list to 5 items with None
-    while len(image_urls) < 5:
-        image_urls.append(None)
+        await db.commit()
+        await db.refresh(profile)
+    
+    # Only validate and spool here; compression and storage run in image_jobs workers,
+    # so the request returns as soon as the files are on disk
+    spooled = []
+    try:
+        for file in files[:5]:
+            spooled.append(await uploads.spool_upload(file, directory=image_jobs.IMAGE_JOB_DIR))
+    except BaseException:
+        for upload in spooled:
+            upload.close()
+        raise
 
-    image_links = {f"image_url{i+1}": url for i, url in enumerate(image_urls)}
-    
     new_item = models.PortfolioItem(
         profile_id=profile.id, # Use the profile object obtained or created above
         title=title,
@@ -321,57 +386,118 @@ async def upload_portfolio(
         description=description,
         item_type=item_type,
         phone=phone,
-        **image_links
+        processing_state=image_jobs.ITEM_PROCESSING
     )
     db.add(new_item)
-    db.commit()
-    db.refresh(new_item)
+    await db.flush()
+    for slot, upload in enumerate(spooled, start=1):
+        db.add(models.ImageJob(item_id=new_item.id, slot=slot, source_path=upload.path, file_name=upload.filename))
+    await db.commit()
+    await db.refresh(new_item)
+    image_jobs.image_jobs.notify()
+    logger.info(f"Queued {len(spooled)} images for portfolio item {new_item.id} of user {current_user.id}")
     return new_item
 
-@app.get("/items", response_model=List[schemas.PortfolioItemPublic])
+@app.get("/portfolio/{item_id}/status", response_model=schemas.PortfolioItemStatus)
+async def get_portfolio_item_status(item_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    item = await db.scalar(select(models.PortfolioItem).join(models.Profile).where(
+        models.PortfolioItem.id == item_id,
+        models.Profile.user_id == current_user.id
+    ))
+    if not item:
+        raise HTTPException(status_code=404, detail="Element topilmadi yoki sizda ruxsat yo'q")
+    jobs = (await db.scalars(
+        select(models.ImageJob).where(models.ImageJob.item_id == item_id).order_by(models.ImageJob.slot)
+    )).all()
+    return {
+        "item_id": item.id,
+        "status": item.processing_state or image_jobs.ITEM_READY,
+        "total": len(jobs),
+        "done": sum(1 for j in jobs if j.status == image_jobs.DONE),
+        "failed": sum(1 for j in jobs if j.status == image_jobs.FAILED),
+        "jobs": jobs,
+    }
+
+ITEMS_PAGE_MAX_LIMIT = 100
+
+@app.get("/items", response_model=Union[schemas.PortfolioItemPage, List[schemas.PortfolioItemPublic]])
 async def get_all_items(
     category_id: Optional[int] = None,
     item_type: Optional[str] = None,
-    db: Session = Depends(database.get_db),
+    limit: Optional[int] = Query(None, ge=1, le=ITEMS_PAGE_MAX_LIMIT),
+    before_id: Optional[int] = None,
+    db: AsyncSession = Depends(database.get_db),
     current_user: Optional[models.User] = Depends(auth.get_current_user_optional) # Need optional auth helper
 ):
-    query = db.query(models.PortfolioItem).join(models.Profile)
-    
-    if category_id:
-        query = query.filter(models.PortfolioItem.category_id == category_id)
-    if item_type:
-        query = query.filter(models.PortfolioItem.item_type == item_type)
-        
     # Filter out items from blocked users if logged in
+    blocked_ids = []
     if current_user:
-        blocked_ids = db.query(models.BlockedUser.blocked_id).filter(models.BlockedUser.blocker_id == current_user.id).all()
-        blocked_ids = [r[0] for r in blocked_ids]
+        blocked_ids = (await db.scalars(
+            select(models.BlockedUser.blocked_id).where(models.BlockedUser.blocker_id == current_user.id)
+        )).all()
+
+    async def load():
+        query = select(models.PortfolioItem).join(models.Profile).options(
+            joinedload(models.PortfolioItem.profile).joinedload(models.Profile.user)
+        )
+        
+        if category_id:
+            query = query.where(models.PortfolioItem.category_id == category_id)
+        if item_type:
+            query = query.where(models.PortfolioItem.item_type == item_type)
         if blocked_ids:
-            query = query.filter(models.Profile.user_id.notin_(blocked_ids))
-            
-    return query.order_by(models.PortfolioItem.id.desc()).all()
+            query = query.where(models.Profile.user_id.notin_(blocked_ids))
+        query = query.where(PUBLIC_ITEM_FILTER)
+
+        query = query.order_by(models.PortfolioItem.id.desc())
+
+        # Legacy mode: old clients that send no limit still get the whole list
+        if limit is None:
+            items = (await db.scalars(query)).all()
+            return [schemas.PortfolioItemPublic.model_validate(i).model_dump(mode="json") for i in items]
+
+        # Keyset pagination: seek past the cursor instead of OFFSET so every page costs the same
+        if before_id is not None:
+            query = query.where(models.PortfolioItem.id < before_id)
+
+        # Fetch one extra row to know whether another page exists
+        items = (await db.scalars(query.limit(limit + 1))).all()
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = items[-1].id
+
+        return schemas.PortfolioItemPage(items=items, next_cursor=next_cursor).model_dump(mode="json")
+
+    # The per-user block filter makes the result personal, so only the shared view is cached
+    if blocked_ids:
+        return await load()
+    key = f"items:{category_id}:{item_type}:{limit}:{before_id}"
+    return await cache.response_cache.get_or_set(key, load, tags=["items"])
 
 @app.post("/items/{item_id}/view")
-async def increment_item_view(item_id: int, db: Session = Depends(database.get_db)):
-    item = db.query(models.PortfolioItem).filter(models.PortfolioItem.id == item_id).first()
-    if not item:
-        raise HTTPException(status_code=404, detail="Element topilmadi")
-    item.views_count = (item.views_count or 0) + 1
-    db.commit()
-    return {"views_count": item.views_count}
+async def increment_item_view(item_id: int):
+    # Buffered in memory and flushed in batches by write_behind.view_counter
+    view_counter.add(item_id)
+    return {"success": True}
 
 @app.delete("/items/{item_id}")
-async def delete_portfolio_item(item_id: int, db: Session = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_user)):
-    item = db.query(models.PortfolioItem).join(models.Profile).filter(
+async def delete_portfolio_item(item_id: int, db: AsyncSession = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_user)):
+    item = await db.scalar(select(models.PortfolioItem).join(models.Profile).where(
         models.PortfolioItem.id == item_id,
         models.Profile.user_id == current_user.id
-    ).first()
+    ))
     
     if not item:
         raise HTTPException(status_code=404, detail="Element topilmadi yoki sizda ruxsat yo'q")
     
-    db.delete(item)
-    db.commit()
+    image_urls = [item.image_url1, item.image_url2, item.image_url3, item.image_url4, item.image_url5]
+    await image_jobs.image_jobs.discard(db, item.id)
+    await db.delete(item)
+    await db.commit()
+    await cache.response_cache.invalidate("items", f"portfolio:{current_user.id}")
+    for url in image_urls:
+        await image_utils.release_image(url)
     return {"message": "Element o'chirildi"}
 
 @app.put("/portfolio/{item_id}", response_model=schemas.PortfolioItem)
@@ -382,16 +508,19 @@ async def update_portfolio_item(
     price_type: str = Form(None),
     status: str = Form(None),
     file: UploadFile = File(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    item = db.query(models.PortfolioItem).join(models.Profile).filter(
+    item = await db.scalar(select(models.PortfolioItem).join(models.Profile).where(
         models.PortfolioItem.id == item_id,
         models.Profile.user_id == current_user.id
-    ).first()
+    ))
     
     if not item:
         raise HTTPException(status_code=404, detail="Element topilmadi yoki sizda ruxsat yo'q")
+    # The background jobs fill in image_url1..5 when they finish and would overwrite this upload
+    if file and item.processing_state == image_jobs.ITEM_PROCESSING:
+        raise HTTPException(status_code=409, detail="Rasmlar hali yuklanmoqda, birozdan so'ng qayta urinib ko'ring")
     
     if title:
         item.title = title
@@ -402,32 +531,80 @@ async def update_portfolio_item(
     if status:
         item.status = status
         
+    replaced_url = None
     if file:
-        file_content = await file.read()
-        image_url = image_utils.upload_image(file_content, file.filename)
-        if image_url:
-            item.image_url1 = image_url
+        async with await uploads.spool_upload(file) as upload:
+            uploaded = await image_utils.upload_image_variants(upload.path, upload.filename)
+        if uploaded and uploaded[0] != item.image_url1:
+            replaced_url = item.image_url1
+            item.image_url1 = uploaded[0]
+            # Reassign rather than mutate so the JSON column is seen as changed
+            variants = list(item.image_variants or [])
+            variants[:1] = [uploaded[1] or None]
+            item.image_variants = variants
             
-    db.commit()
-    db.refresh(item)
+    await db.commit()
+    await db.refresh(item)
+    await cache.response_cache.invalidate("items", f"portfolio:{current_user.id}")
+    await image_utils.release_image(replaced_url)
     return item
 
 # --- Messaging Endpoints ---
 
+async def _is_blocked(db: AsyncSession, blocker_id: int, blocked_id: int) -> bool:
+    return await db.scalar(select(models.BlockedUser.id).where(
+        models.BlockedUser.blocker_id == blocker_id,
+        models.BlockedUser.blocked_id == blocked_id
+    ).limit(1)) is not None
+
+async def _publish_message(db: AsyncSession, msg: models.Message, conv: models.Conversation, muted: bool):
+    """Pushes a committed message to both users' sockets, plus the receiver's new unread counts."""
+    event = {"type": "message", "message": schemas.Message.model_validate(msg).model_dump(mode="json")}
+    await realtime.hub.publish(msg.sender_id, event)
+    # The receiver's inbox hides blocked users, so their sockets stay quiet too
+    if msg.receiver_id == msg.sender_id or muted:
+        return
+    await db.refresh(conv, ["unread_a", "unread_b"])
+    await realtime.hub.publish(msg.receiver_id, event)
+    await realtime.hub.publish(msg.receiver_id, {
+        "type": "unread",
+        "user_id": msg.sender_id,
+        "unread_count": conversations.unread_for(conv, msg.receiver_id),
+        "total": await conversations.unread_total(db, msg.receiver_id),
+    })
+
+@app.websocket("/ws/messages")
+async def messages_socket(websocket: WebSocket, token: Optional[str] = None):
+    """New messages, read receipts and unread counters, pushed as they happen (see realtime.py)."""
+    # Browsers can't set headers on a WebSocket, so the token may come as ?token=
+    if token is None:
+        authorization = websocket.headers.get("authorization", "")
+        token = authorization[7:] if authorization.lower().startswith("bearer ") else None
+    user = await auth.authenticate_token(token)
+    if user is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    await realtime.hub.serve(user.id, websocket)
+
 @app.post("/messages/send", response_model=schemas.Message)
-async def send_message(msg: schemas.MessageCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+async def send_message(msg: schemas.MessageCreate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
     new_msg = models.Message(
         sender_id=current_user.id,
         receiver_id=msg.receiver_id,
         content=msg.content
     )
+    muted = await _is_blocked(db, msg.receiver_id, current_user.id)
     db.add(new_msg)
-    db.commit()
-    db.refresh(new_msg)
+    await db.flush()
+    conv = await conversations.record_message(db, new_msg, count_unread=not muted)
+    await db.commit()
+    await db.refresh(new_msg)
+    await _publish_message(db, new_msg, conv, muted)
     
     # Send Telegram notification to receiver
-    receiver = db.query(models.User).filter(models.User.id == msg.receiver_id).first()
-    sender_profile = db.query(models.Profile).filter(models.Profile.user_id == current_user.id).first()
+    receiver = await db.get(models.User, msg.receiver_id)
+    sender_profile = await db.scalar(select(models.Profile).where(models.Profile.user_id == current_user.id))
     sender_name = sender_profile.full_name if sender_profile and sender_profile.full_name else "Foydalanuvchi"
     
     # Silent Chat: Disabled Telegram notifications for internal messages per user request.
@@ -448,86 +625,112 @@ async def send_message(msg: schemas.MessageCreate, db: Session = Depends(get_db)
     return new_msg
 
 @app.get("/messages/chats")
-async def get_my_chats(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    # Find all users I've chatted with
-    sent_to = db.query(models.Message.receiver_id).filter(models.Message.sender_id == current_user.id).distinct()
-    recv_from = db.query(models.Message.sender_id).filter(models.Message.receiver_id == current_user.id).distinct()
-    
-    user_ids = [r[0] for r in sent_to.all()] + [r[0] for r in recv_from.all()]
-    # Unique IDs
-    user_ids = list(set(user_ids)) 
+async def get_my_chats(db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    # One indexed query over the maintained conversation summaries
+    convs = (await db.scalars(select(models.Conversation).where(
+        (models.Conversation.user_a_id == current_user.id) | (models.Conversation.user_b_id == current_user.id)
+    ).order_by(models.Conversation.last_message_at.desc()))).all()
     
     # Filter out blocked users
-    blocked_ids = db.query(models.BlockedUser.blocked_id).filter(models.BlockedUser.blocker_id == current_user.id).all()
-    blocked_ids = [r[0] for r in blocked_ids]
-    user_ids = [uid for uid in user_ids if uid not in blocked_ids]
+    blocked_ids = set((await db.scalars(
+        select(models.BlockedUser.blocked_id).where(models.BlockedUser.blocker_id == current_user.id)
+    )).all())
+    convs = [c for c in convs if conversations.partner_of(c, current_user.id) not in blocked_ids]
+    
+    # Batch-load partners and their profiles in a single query
+    partner_ids = [conversations.partner_of(c, current_user.id) for c in convs]
+    partners = {}
+    if partner_ids:
+        rows = (await db.execute(select(models.User, models.Profile).outerjoin(
+            models.Profile, models.Profile.user_id == models.User.id
+        ).where(models.User.id.in_(partner_ids)))).all()
+        partners = {user.id: (user, profile) for user, profile in rows}
     
     result = []
-    for uid in user_ids:
-        user = db.query(models.User).filter(models.User.id == uid).first()
-        profile = db.query(models.Profile).filter(models.Profile.user_id == uid).first()
-        last_msg = db.query(models.Message).filter(
-            ((models.Message.sender_id == current_user.id) & (models.Message.receiver_id == uid)) |
-            ((models.Message.sender_id == uid) & (models.Message.receiver_id == current_user.id))
-        ).order_by(models.Message.created_at.desc()).first()
-        
-        unread_count = db.query(models.Message).filter(
-            models.Message.sender_id == uid,
-            models.Message.receiver_id == current_user.id,
-            models.Message.is_read == False
-        ).count()
-        
+    for conv in convs:
+        uid = conversations.partner_of(conv, current_user.id)
+        user, profile = partners.get(uid, (None, None))
         result.append({
             "user_id": uid,
             "full_name": profile.full_name if profile and profile.full_name else (user.phone if user else "Foydalanuvchi"),
             "avatar_url": profile.avatar_url if profile else None,
-            "last_message": last_msg.content if last_msg else "",
-            "last_message_time": last_msg.created_at if last_msg else None,
-            "unread_count": unread_count
+            "last_message": conv.last_message_preview or "",
+            "last_message_time": conv.last_message_at,
+            "unread_count": conversations.unread_for(conv, current_user.id)
         })
     
-    # Sort by last message time
-    result.sort(key=lambda x: x["last_message_time"] if x["last_message_time"] else datetime.min, reverse=True)
     return result
 
+# Declared before /messages/{user_id} so "unread" isn't parsed as a user id
+@app.get("/messages/unread", response_model=schemas.UnreadCount)
+async def get_unread_count(db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    """App badge: one primary key lookup on the maintained counter."""
+    return {"total": await conversations.unread_total(db, current_user.id)}
+
 @app.post("/messages/send-image", response_model=schemas.Message)
 async def send_message_with_image(
     receiver_id: int = Form(...),
     content: Optional[str] = Form(None),
     file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    # Check daily limit (5 images per day)
-    today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    img_count = db.query(models.Message).filter(
-        models.Message.sender_id == current_user.id,
-        models.Message.image_url.isnot(None),
-        models.Message.created_at >= today_start
-    ).count()
-    
-    if img_count >= 5:
-        raise HTTPException(status_code=400, detail="Kunlik rasm yuborish limiti (5 ta) tugadi")
+    # Daily image limit (UTC day). A shared quota store keeps one counter; a per-process one
+    # would reset on every restart and count per worker, so then today's messages are counted
+    counted = quotas.engine.shared
+    if counted:
+        allowed = (await quotas.engine.consume(quotas.IMAGE_MESSAGES, current_user.id)).allowed
+    else:
+        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        allowed = await db.scalar(select(func.count()).select_from(models.Message).where(
+            models.Message.sender_id == current_user.id,
+            models.Message.image_url.isnot(None),
+            models.Message.created_at >= today_start
+        )) < quotas.IMAGE_MESSAGES.limit
+    if not allowed:
+        raise HTTPException(status_code=400, detail=f"Kunlik rasm yuborish limiti ({quotas.IMAGE_MESSAGES.limit} ta) tugadi")
     
     logger.info(f"Receiving image for user {current_user.id} to receiver {receiver_id}")
-    file_content = await file.read()
-    logger.info(f"File size: {len(file_content)} bytes, filename: {file.filename}")
-    image_url = image_utils.upload_image(file_content, file.filename)
-    logger.info(f"Uploaded URL: {image_url}")
-    
-    if not image_url:
+    try:
+        async with await uploads.spool_upload(file) as upload:
+            logger.info(f"File size: {upload.size} bytes, filename: {file.filename}")
+            uploaded = await image_utils.upload_image_variants(upload.path, upload.filename)
+    except Exception:
+        # Rejected or busy upload: it must not use up one of the day's images
+        if counted:
+            await quotas.engine.refund(quotas.IMAGE_MESSAGES, current_user.id)
+        raise
+    logger.info(f"Uploaded URL: {uploaded and uploaded[0]}")
+    
+    if not uploaded:
+        if counted:
+            await quotas.engine.refund(quotas.IMAGE_MESSAGES, current_user.id)
         logger.error(f"Image upload failed for user {current_user.id}")
         raise HTTPException(status_code=500, detail="Rasmni yuklashda xatolik yuz berdi")
+    image_url, image_variants = uploaded
     
     new_msg = models.Message(
         sender_id=current_user.id,
         receiver_id=receiver_id,
         content=content,
-        image_url=image_url
+        image_url=image_url,
+        image_variants=image_variants or None
     )
-    db.add(new_msg)
-    db.commit()
-    db.refresh(new_msg)
+    try:
+        muted = await _is_blocked(db, receiver_id, current_user.id)
+        db.add(new_msg)
+        await db.flush()
+        conv = await conversations.record_message(db, new_msg, count_unread=not muted)
+        await db.commit()
+    except Exception:
+        # No message was stored: give the image and the day's unit back
+        await db.rollback()
+        if counted:
+            await quotas.engine.refund(quotas.IMAGE_MESSAGES, current_user.id)
+        await image_utils.release_image(image_url)
+        raise
+    await db.refresh(new_msg)
+    await _publish_message(db, new_msg, conv, muted)
     
     # Notification logic
     # Silent Chat: Disabled Telegram notifications for internal messages per user request.
@@ -548,28 +751,97 @@ async def send_message_with_image(
 
     return new_msg
 
-@app.get("/messages/{user_id}", response_model=List[schemas.Message])
-async def get_chat_history(user_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    messages = db.query(models.Message).filter(
-        ((models.Message.sender_id == current_user.id) & (models.Message.receiver_id == user_id)) |
-        ((models.Message.sender_id == user_id) & (models.Message.receiver_id == current_user.id))
-    ).order_by(models.Message.created_at.asc()).all()
-    return messages
+MESSAGES_PAGE_MAX_LIMIT = 200
+
+async def _pair_messages(db: AsyncSession, model, user_id: int, other_id: int, newest_first: bool, limit: int,
+                         after_id: Optional[int] = None, before_id: Optional[int] = None):
+    """
+    Up to `limit` messages of the pair from `model` (Message or ArchivedMessage), ordered by id.
+    One query per direction, so each is a range scan on the (sender_id, receiver_id, id)
+    index instead of sorting the whole thread.
+    """
+    order = model.id.desc() if newest_first else model.id.asc()
+    messages = []
+    for sender_id, receiver_id in ((user_id, other_id), (other_id, user_id)):
+        query = select(model).where(model.sender_id == sender_id, model.receiver_id == receiver_id)
+        if after_id is not None:
+            query = query.where(model.id > after_id)
+        if before_id is not None:
+            query = query.where(model.id < before_id)
+        messages += (await db.scalars(query.order_by(order).limit(limit))).all()
+    messages.sort(key=lambda m: m.id, reverse=newest_first)
+    return messages[:limit]
+
+@app.get("/messages/{user_id}", response_model=Union[schemas.MessagePage, List[schemas.Message]])
+async def get_chat_history(
+    user_id: int,
+    since_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MESSAGES_PAGE_MAX_LIMIT),
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """
+    since_id: only messages newer than the last one the client has (reopening a chat).
+    limit (+ before_id): the newest page, then older pages by scrolling back.
+    Both answer a MessagePage; with neither, old clients still get the whole thread.
+    Archived messages (archive.py) have lower ids than all hot ones, so each mode
+    reads `messages` and only continues into the archive when it runs out.
+    """
+    if since_id is None and limit is None and before_id is None:
+        messages = []
+        for model in (models.ArchivedMessage, models.Message):
+            messages += (await db.scalars(select(model).where(
+                ((model.sender_id == current_user.id) & (model.receiver_id == user_id)) |
+                ((model.sender_id == user_id) & (model.receiver_id == current_user.id))
+            ).order_by(model.created_at.asc()))).all()
+        return messages
+
+    page_size = limit or MESSAGES_PAGE_MAX_LIMIT
+    # Fetch one extra row to know whether another page exists
+    if since_id is not None:
+        messages = []
+        # A client that has been away longer than the archive age resumes inside the archive
+        if since_id < await archive.max_archived_id(db):
+            messages = await _pair_messages(db, models.ArchivedMessage, current_user.id, user_id, False, page_size + 1, after_id=since_id)
+        if len(messages) <= page_size:
+            messages += await _pair_messages(db, models.Message, current_user.id, user_id, False, page_size + 1 - len(messages), after_id=since_id)
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+        next_cursor = messages[-1].id if has_more else None
+    else:
+        messages = await _pair_messages(db, models.Message, current_user.id, user_id, True, page_size + 1, before_id=before_id)
+        if len(messages) <= page_size:
+            # Scrolled past the hot rows: continue below the oldest one in the archive
+            cursor = messages[-1].id if messages else before_id
+            messages += await _pair_messages(db, models.ArchivedMessage, current_user.id, user_id, True, page_size + 1 - len(messages), before_id=cursor)
+        has_more = len(messages) > page_size
+        messages = messages[:page_size][::-1]
+        next_cursor = messages[0].id if has_more else None
+    return schemas.MessagePage(items=messages, next_cursor=next_cursor)
 
 @app.post("/messages/{user_id}/read")
-async def mark_messages_as_read(user_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    db.query(models.Message).filter(
-        models.Message.sender_id == user_id,
-        models.Message.receiver_id == current_user.id,
-        models.Message.is_read == False
-    ).update({models.Message.is_read: True})
-    db.commit()
+async def mark_messages_as_read(user_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    # Unread messages can be old enough to be archived already
+    for model in (models.Message, models.ArchivedMessage):
+        await db.execute(update(model).where(
+            model.sender_id == user_id,
+            model.receiver_id == current_user.id,
+            model.is_read == False
+        ).values(is_read=True))
+    await conversations.mark_read(db, current_user.id, user_id)
+    await db.commit()
+    # The reader's other devices clear the badge; the sender sees a read receipt
+    await realtime.hub.publish(current_user.id, {
+        "type": "unread", "user_id": user_id, "unread_count": 0, "total": await conversations.unread_total(db, current_user.id)
+    })
+    await realtime.hub.publish(user_id, {"type": "read", "user_id": current_user.id})
     return {"message": "Success"}
 
 # --- Review Endpoints ---
 
 @app.post("/reviews/{user_id}", response_model=schemas.Review)
-async def create_review(user_id: int, review: schemas.ReviewBase, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+async def create_review(user_id: int, review: schemas.ReviewBase, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
     if current_user.id == user_id:
         raise HTTPException(status_code=400, detail="O'zingizga sharh qoldira olmaysiz")
     
@@ -580,45 +852,55 @@ async def create_review(user_id: int, review: schemas.ReviewBase, db: Session =
         text=review.text
     )
     db.add(new_review)
-    db.commit()
-    db.refresh(new_review)
+    await db.commit()
+    await db.refresh(new_review)
     
     # Update dynamic rating
-    avg_rating = db.query(func.avg(models.Review.stars)).filter(models.Review.to_user_id == user_id).scalar()
-    target_user = db.query(models.User).filter(models.User.id == user_id).first()
+    avg_rating = await db.scalar(select(func.avg(models.Review.stars)).where(models.Review.to_user_id == user_id))
+    target_user = await db.get(models.User, user_id)
     if target_user:
         target_user.rating = float(avg_rating)
-        db.commit()
-        
+        await db.commit()
+        auth.invalidate_user(target_user.phone)
+    
+    # Rating is embedded in the profile and in every listing of that user
+    await cache.response_cache.invalidate(f"reviews:{user_id}", f"profile:{user_id}", "items")
     return new_review
 
 @app.get("/reviews/{user_id}", response_model=List[schemas.Review])
-async def get_user_reviews(user_id: int, db: Session = Depends(get_db)):
-    return db.query(models.Review).filter(models.Review.to_user_id == user_id).order_by(models.Review.created_at.desc()).all()
+async def get_user_reviews(user_id: int, db: AsyncSession = Depends(get_db)):
+    async def load():
+        reviews = await db.scalars(select(models.Review).where(models.Review.to_user_id == user_id).order_by(models.Review.created_at.desc()))
+        return [schemas.Review.model_validate(r).model_dump(mode="json") for r in reviews]
+
+    return await cache.response_cache.get_or_set(f"reviews:{user_id}", load, tags=[f"reviews:{user_id}"])
 
 # --- UGC Safety: Block and Report ---
 
 @app.post("/users/{user_id}/block")
-async def block_user(user_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+async def block_user(user_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
     if current_user.id == user_id:
         raise HTTPException(status_code=400, detail="O'zingizni blocklay olmaysiz")
     
     # Check if already blocked
-    existing = db.query(models.BlockedUser).filter(
+    existing = await db.scalar(select(models.BlockedUser).where(
         models.BlockedUser.blocker_id == current_user.id,
         models.BlockedUser.blocked_id == user_id
-    ).first()
+    ))
     
     if existing:
         return {"message": "Foydalanuvchi allaqachon blocklangan"}
     
     new_block = models.BlockedUser(blocker_id=current_user.id, blocked_id=user_id)
     db.add(new_block)
-    db.commit()
+    # The chat disappears from the inbox, so its unread messages must leave the badge too
+    await conversations.mark_read(db, current_user.id, user_id)
+    await db.commit()
     return {"message": "Foydalanuvchi blocklandi"}
 
 @app.post("/reports", response_model=schemas.Report)
-async def create_report(report: schemas.ReportBase, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+async def create_report(report: schemas.ReportBase, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+    await quotas.engine.enforce(quotas.REPORTS, current_user.id)
     new_report = models.Report(
         reporter_id=current_user.id,
         reported_user_id=report.reported_user_id,
@@ -627,8 +909,8 @@ async def create_report(report: schemas.ReportBase, db: Session = Depends(get_db
         details=report.details
     )
     db.add(new_report)
-    db.commit()
-    db.refresh(new_report)
+    await db.commit()
+    await db.refresh(new_report)
     return new_report
 
 # Note: Admin and Ad endpoints have been moved to admin_ads.py
@@ -0,0 +1,266 @@
+"""
+Versioned schema migrations for SQLite and PostgreSQL.
+
+Every migration has a version number and is applied at most once; applied
+versions are recorded in the `schema_migrations` table. The API applies
+pending migrations at startup, and they can also be run by hand:
+
+    python migrations.py            # apply pending migrations
+    python migrations.py --status   # list applied / pending versions
+
+New migrations are appended to MIGRATIONS with the next version number.
+Statements must be idempotent (IF NOT EXISTS, inspector checks) so a
+database that was already patched by the old one-off scripts upgrades cleanly.
+"""
+import logging
+import sys
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Union
+
+from sqlalchemy import MetaData, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for pg_advisory_xact_lock so parallel workers don't race
+PG_LOCK_KEY = 74201
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    steps: Union[List[str], Callable[[Connection], None]]
+
+    def apply(self, conn: Connection):
+        if callable(self.steps):
+            self.steps(conn)
+        else:
+            for statement in self.steps:
+                conn.execute(text(statement))
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str):
+    inspector = inspect(conn)
+    if not inspector.has_table(table):
+        return
+    columns = [c["name"] for c in inspector.get_columns(table)]
+    if column not in columns:
+        logger.info(f"Adding column '{column}' to '{table}'")
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _legacy_columns(conn: Connection):
+    """Columns that used to be added by migrate_db.py, migrate_otp.py, etc."""
+    _add_column(conn, "portfolio_items", "views_count", "INTEGER DEFAULT 0")
+    _add_column(conn, "portfolio_items", "description", "TEXT")
+    _add_column(conn, "portfolio_items", "item_type", "VARCHAR DEFAULT 'service'")
+    _add_column(conn, "portfolio_items", "phone", "VARCHAR")
+    _add_column(conn, "users", "otp_code", "VARCHAR")
+    _add_column(conn, "users", "otp_created_at", "TIMESTAMP")
+    _add_column(conn, "messages", "image_url", "VARCHAR")
+
+
+def _backfill_conversations(conn: Connection):
+    """Builds conversation summaries from the existing messages."""
+    import models
+    models.Conversation.__table__.create(conn, checkfirst=True)
+    conn.execute(text("DELETE FROM conversations"))
+    conn.execute(text(
+        "INSERT INTO conversations (user_a_id, user_b_id, last_message_id, unread_a, unread_b) "
+        "SELECT CASE WHEN sender_id < receiver_id THEN sender_id ELSE receiver_id END, "
+        "CASE WHEN sender_id < receiver_id THEN receiver_id ELSE sender_id END, "
+        "MAX(id), "
+        "SUM(CASE WHEN is_read = false AND receiver_id <= sender_id THEN 1 ELSE 0 END), "
+        "SUM(CASE WHEN is_read = false AND receiver_id > sender_id THEN 1 ELSE 0 END) "
+        "FROM messages GROUP BY 1, 2"
+    ))
+    conn.execute(text(
+        "UPDATE conversations SET "
+        "last_message_preview = (SELECT SUBSTR(COALESCE(m.content, ''), 1, 100) FROM messages m WHERE m.id = conversations.last_message_id), "
+        "last_message_at = (SELECT m.created_at FROM messages m WHERE m.id = conversations.last_message_id)"
+    ))
+    _clear_blocked_unread(conn)
+
+
+def _clear_blocked_unread(conn: Connection):
+    """Zeroes the reader's unread count in chats they have blocked, as block_user does: those chats are hidden from the inbox."""
+    if not inspect(conn).has_table("blocked_users"):
+        return
+    for reader, partner in (("a", "b"), ("b", "a")):
+        conn.execute(text(
+            f"UPDATE conversations SET unread_{reader} = 0 WHERE EXISTS ("
+            f"SELECT 1 FROM blocked_users b WHERE b.blocker_id = conversations.user_{reader}_id "
+            f"AND b.blocked_id = conversations.user_{partner}_id)"
+        ))
+
+
+def _unread_counters(conn: Connection):
+    """Per-user unread totals, summed from the conversation counters."""
+    import models
+    models.UnreadCounter.__table__.create(conn, checkfirst=True)
+    _clear_blocked_unread(conn)
+    conn.execute(text("DELETE FROM unread_counters"))
+    conn.execute(text(
+        "INSERT INTO unread_counters (user_id, unread) "
+        "SELECT user_id, SUM(unread) FROM ("
+        "SELECT user_a_id AS user_id, COALESCE(unread_a, 0) AS unread FROM conversations "
+        "UNION ALL SELECT user_b_id, COALESCE(unread_b, 0) FROM conversations"
+        ") AS per_pair GROUP BY user_id"
+    ))
+
+
+def _message_archive(conn: Connection):
+    import models
+    models.ArchivedMessage.__table__.create(conn, checkfirst=True)
+    _monotonic_message_ids(conn)
+
+
+def _monotonic_message_ids(conn: Connection):
+    """
+    SQLite hands out max(id) + 1 unless the table is AUTOINCREMENT, so once the
+    archive has emptied `messages` new rows would reuse archived ids. Rebuilds
+    the table with AUTOINCREMENT and starts its sequence above both tables.
+    """
+    if conn.dialect.name != "sqlite":
+        return  # PostgreSQL sequences never go back
+    import models
+    table = models.Message.__table__
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages'")).scalar()
+    if ddl and "AUTOINCREMENT" not in ddl.upper():
+        columns = [c["name"] for c in inspect(conn).get_columns("messages") if c["name"] in table.c]
+        scratch = MetaData()
+        models.User.__table__.to_metadata(scratch)  # so the foreign keys resolve
+        rebuilt = table.to_metadata(scratch, name="messages_rebuilt")
+        rebuilt.indexes.clear()  # index names are global in SQLite; recreated after the swap
+        rebuilt.create(conn)
+        column_list = ", ".join(columns)
+        conn.execute(text(f"INSERT INTO messages_rebuilt ({column_list}) SELECT {column_list} FROM messages"))
+        conn.execute(text("DROP TABLE messages"))
+        conn.execute(text("ALTER TABLE messages_rebuilt RENAME TO messages"))
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    highest = conn.execute(text(
+        "SELECT MAX(id) FROM (SELECT MAX(id) AS id FROM messages UNION ALL SELECT MAX(id) FROM messages_archive) AS ids"
+    )).scalar() or 0
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'messages'"))
+    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', :seq)"), {"seq": highest})
+
+
+def _image_assets(conn: Connection):
+    import models
+    models.ImageAsset.__table__.create(conn, checkfirst=True)
+
+
+def _image_variants(conn: Connection):
+    _add_column(conn, "image_assets", "variants", "JSON")
+    _add_column(conn, "portfolio_items", "image_variants", "JSON")
+    _add_column(conn, "messages", "image_variants", "JSON")
+
+
+def _image_asset_files(conn: Connection):
+    """Indexes the file ids kept inside image_assets.variants for exact lookups."""
+    import models
+    models.ImageAssetFile.__table__.create(conn, checkfirst=True)
+    conn.execute(text("DELETE FROM image_asset_files"))
+    assets = models.ImageAsset.__table__
+    rows = []
+    for asset_id, file_id, variants in conn.execute(select(assets.c.id, assets.c.file_id, assets.c.variants)):
+        file_ids = {file_id} | {f.get("file_id") for formats in (variants or {}).values() for f in formats.values()}
+        rows += [{"asset_id": asset_id, "file_id": f} for f in file_ids if f]
+    if rows:
+        conn.execute(models.ImageAssetFile.__table__.insert(), rows)
+
+
+def _image_jobs(conn: Connection):
+    import models
+    _add_column(conn, "portfolio_items", "status", "VARCHAR DEFAULT 'available'")
+    models.ImageJob.__table__.create(conn, checkfirst=True)
+
+
+def _processing_state(conn: Connection):
+    """Moves image job progress out of the owner-editable status column."""
+    _add_column(conn, "portfolio_items", "processing_state", "VARCHAR DEFAULT 'ready'")
+    conn.execute(text(
+        "UPDATE portfolio_items SET processing_state = status, status = 'available' "
+        "WHERE status IN ('processing', 'failed')"
+    ))
+
+
+MIGRATIONS = [
+    Migration(1, "Legacy columns from one-off scripts", _legacy_columns),
+    Migration(2, "Hot path indexes", [
+        "CREATE INDEX IF NOT EXISTS ix_portfolio_items_category_type_id ON portfolio_items (category_id, item_type, id)",
+        "CREATE INDEX IF NOT EXISTS ix_portfolio_items_profile_id ON portfolio_items (profile_id)",
+        "CREATE INDEX IF NOT EXISTS ix_messages_sender_receiver_created ON messages (sender_id, receiver_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_messages_receiver_is_read ON messages (receiver_id, is_read)",
+        "CREATE INDEX IF NOT EXISTS ix_reviews_to_user_created ON reviews (to_user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_blocked_users_blocker_blocked ON blocked_users (blocker_id, blocked_id)",
+        "CREATE INDEX IF NOT EXISTS ix_profiles_user_id ON profiles (user_id)",
+    ]),
+    Migration(3, "Conversation summaries", _backfill_conversations),
+    Migration(4, "Content-addressed image index", _image_assets),
+    Migration(5, "Responsive image variants", _image_variants),
+    Migration(6, "Background image jobs", _image_jobs),
+    Migration(7, "Chat history keyset index", [
+        "CREATE INDEX IF NOT EXISTS ix_messages_sender_receiver_id ON messages (sender_id, receiver_id, id)",
+    ]),
+    Migration(8, "Per-user unread totals", _unread_counters),
+    Migration(9, "Cold message archive", _message_archive),
+    Migration(10, "Image asset file index", _image_asset_files),
+    Migration(11, "Portfolio image processing state", _processing_state),
+]
+
+
+def _ensure_version_table(conn: Connection):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR, "
+        "applied_at TIMESTAMP)"
+    ))
+
+
+def applied_versions(conn: Connection) -> set:
+    _ensure_version_table(conn)
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def run_migrations(engine: Engine) -> List[int]:
+    """Applies all pending migrations, each in its own transaction. Returns applied versions."""
+    applied = []
+    with engine.begin() as conn:
+        _ensure_version_table(conn)
+
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PG_LOCK_KEY})
+            # Re-check under the lock: another worker may have applied it meanwhile
+            if migration.version in applied_versions(conn):
+                continue
+            logger.info(f"Applying migration {migration.version}: {migration.description}")
+            migration.apply(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)"),
+                {"v": migration.version, "d": migration.description, "t": datetime.utcnow()}
+            )
+            applied.append(migration.version)
+    return applied
+
+
+if __name__ == "__main__":
+    from database import engine, SQLALCHEMY_DATABASE_URL
+    import models
+
+    print(f"Database: {SQLALCHEMY_DATABASE_URL}")
+    if "--status" in sys.argv:
+        with engine.begin() as conn:
+            done = applied_versions(conn)
+        for m in MIGRATIONS:
+            print(f"[{'x' if m.version in done else ' '}] {m.version}: {m.description}")
+    else:
+        models.Base.metadata.create_all(bind=engine)
+        versions = run_migrations(engine)
+        print(f"Applied migrations: {versions}" if versions else "Database is up to date.")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Float, Enum as SQLEnum, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Float, Enum as SQLEnum, Text, JSON, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -42,7 +42,7 @@ class Profile(Base):
     __tablename__ = "profiles"
     
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     category_id = Column(Integer, nullable=True)
     full_name = Column(String, nullable=True)
     avatar_url = Column(String, nullable=True)
@@ -58,12 +58,13 @@ class PortfolioItem(Base):
     __tablename__ = "portfolio_items"
     
     id = Column(Integer, primary_key=True, index=True)
-    profile_id = Column(Integer, ForeignKey("profiles.id"))
+    profile_id = Column(Integer, ForeignKey("profiles.id"), index=True)
     image_url1 = Column(String)
     image_url2 = Column(String, nullable=True)
     image_url3 = Column(String, nullable=True)
     image_url4 = Column(String, nullable=True)
     image_url5 = Column(String, nullable=True)
+    image_variants = Column(JSON, nullable=True)  # per image slot: {"thumb"/"card"/"full": {"webp": url, "jpeg": url}}
     title = Column(String)
     price = Column(Float, nullable=True)
     price_type = Column(String, nullable=True)
@@ -73,9 +74,15 @@ class PortfolioItem(Base):
     category_id = Column(Integer, nullable=True)
     phone = Column(String, nullable=True)
     views_count = Column(Integer, default=0)
+    status = Column(String, default="available")  # set by the owner
+    processing_state = Column(String, default="ready")  # processing -> ready | failed, set by image_jobs
     
     profile = relationship("Profile", back_populates="items")
 
+    __table_args__ = (
+        Index("ix_portfolio_items_category_type_id", "category_id", "item_type", "id"),
+    )
+
 class Review(Base):
     __tablename__ = "reviews"
     
@@ -86,6 +93,10 @@ class Review(Base):
     text = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_reviews_to_user_created", "to_user_id", "created_at"),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
     
@@ -94,12 +105,66 @@ class Message(Base):
     receiver_id = Column(Integer, ForeignKey("users.id"))
     content = Column(String, nullable=True)
     image_url = Column(String, nullable=True)
+    image_variants = Column(JSON, nullable=True)
     is_read = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     sender = relationship("User", foreign_keys=[sender_id])
     receiver = relationship("User", foreign_keys=[receiver_id])
 
+    __table_args__ = (
+        Index("ix_messages_sender_receiver_created", "sender_id", "receiver_id", "created_at"),
+        Index("ix_messages_sender_receiver_id", "sender_id", "receiver_id", "id"),
+        Index("ix_messages_receiver_is_read", "receiver_id", "is_read"),
+        # Never reuse ids on SQLite, even once archive.py has emptied the table
+        {"sqlite_autoincrement": True},
+    )
+
+class ArchivedMessage(Base):
+    """Messages moved out of `messages` by archive.py once they are old; ids are kept."""
+    __tablename__ = "messages_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    sender_id = Column(Integer, ForeignKey("users.id"))
+    receiver_id = Column(Integer, ForeignKey("users.id"))
+    content = Column(String, nullable=True)
+    image_url = Column(String, nullable=True)
+    image_variants = Column(JSON, nullable=True)
+    is_read = Column(Boolean, default=False)
+    created_at = Column(DateTime)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_messages_archive_sender_receiver_id", "sender_id", "receiver_id", "id"),
+        Index("ix_messages_archive_receiver_is_read", "receiver_id", "is_read"),
+    )
+
+class Conversation(Base):
+    """Per-pair inbox summary, kept up to date by the messaging endpoints."""
+    __tablename__ = "conversations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_a_id = Column(Integer, ForeignKey("users.id"))  # always the smaller user id of the pair
+    user_b_id = Column(Integer, ForeignKey("users.id"))
+    last_message_id = Column(Integer, nullable=True)
+    last_message_preview = Column(String, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    unread_a = Column(Integer, default=0)  # messages user_a has not read yet
+    unread_b = Column(Integer, default=0)
+
+    __table_args__ = (
+        UniqueConstraint("user_a_id", "user_b_id", name="uq_conversations_pair"),
+        Index("ix_conversations_user_a_last", "user_a_id", "last_message_at"),
+        Index("ix_conversations_user_b_last", "user_b_id", "last_message_at"),
+    )
+
+class UnreadCounter(Base):
+    """Per-user unread total (the sum of the user's conversation counters), so the badge is one key lookup."""
+    __tablename__ = "unread_counters"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    unread = Column(Integer, default=0, nullable=False)
+
 # === ADVERTISEMENT MODELS ===
 
 class Advertisement(Base):
@@ -150,6 +215,10 @@ class BlockedUser(Base):
     blocked_id = Column(Integer, ForeignKey("users.id"))
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_blocked_users_blocker_blocked", "blocker_id", "blocked_id"),
+    )
+
 class Report(Base):
     __tablename__ = "reports"
     
@@ -161,3 +230,47 @@ class Report(Base):
     details = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     is_resolved = Column(Boolean, default=False)
+
+class ImageAsset(Base):
+    """One hosted file per distinct (upload bytes, transform) pair, shared by every row that uses its URL."""
+    __tablename__ = "image_assets"
+
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String(64), unique=True, index=True)
+    url = Column(String, index=True)
+    file_id = Column(String, nullable=True)
+    variants = Column(JSON, nullable=True)  # {name: {format: {"url", "file_id"}}}
+    ref_count = Column(Integer, default=1)
+    size_bytes = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ImageAssetFile(Base):
+    """Every stored file of an asset (original and variants), so a file can be looked up without scanning JSON."""
+    __tablename__ = "image_asset_files"
+
+    id = Column(Integer, primary_key=True, index=True)
+    asset_id = Column(Integer, ForeignKey("image_assets.id"), index=True)
+    file_id = Column(String, index=True)
+
+class ImageJob(Base):
+    """One portfolio image waiting to be processed and stored by image_jobs workers."""
+    __tablename__ = "image_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    item_id = Column(Integer, ForeignKey("portfolio_items.id"), index=True)
+    slot = Column(Integer)  # 1-5, order the file was uploaded in
+    source_path = Column(String)
+    file_name = Column(String, nullable=True)
+    status = Column(String, default="pending")  # pending, running, done, failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text, nullable=True)
+    run_after = Column(DateTime, default=datetime.utcnow)
+    locked_until = Column(DateTime, nullable=True)
+    url = Column(String, nullable=True)
+    variants = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_image_jobs_status_run_after", "status", "run_after"),
+    )
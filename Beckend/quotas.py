@@ -0,0 +1,253 @@
+"""
+Per-subject quotas and rate limits without counting rows.
+
+A policy says how much a subject (user id, phone number, ...) may do:
+
+    FixedWindow("image_messages", limit=5, window=86400)    5 per UTC day
+    TokenBucket("otp", capacity=3, refill_every=60)          bursts of 3, then 1 a minute
+
+and the engine keeps one small counter per (policy, subject):
+
+    decision = await quotas.engine.consume(quotas.IMAGE_MESSAGES, current_user.id)
+    if not decision.allowed: ...
+    await quotas.engine.enforce(quotas.REPORTS, current_user.id)   # raises 429 + Retry-After
+
+Store is chosen by QUOTA_BACKEND: "redis" (shared between workers,
+QUOTA_REDIS_URL) or "memory" (per process, reset on restart). Left unset,
+it is redis whenever QUOTA_REDIS_URL is set or the response cache already
+uses redis, and memory otherwise. The memory store enforces each limit per
+worker, so limits that must survive restarts check engine.shared and fall
+back to the database (see send_message_with_image). Any Redis-protocol
+server works, fakeredis included.
+"""
+import logging
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Union
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+@dataclass(frozen=True)
+class FixedWindow:
+    """At most `limit` per window; windows are aligned to the epoch, so 86400 means a UTC calendar day."""
+    name: str
+    limit: int
+    window: int
+
+
+@dataclass(frozen=True)
+class TokenBucket:
+    """Up to `capacity` at once, refilled by one every `refill_every` seconds."""
+    name: str
+    capacity: int
+    refill_every: float
+
+
+Policy = Union[FixedWindow, TokenBucket]
+
+
+@dataclass
+class Decision:
+    allowed: bool
+    remaining: int
+    retry_after: int  # seconds until the next unit is available (0 when allowed)
+
+
+class MemoryStore:
+    """Counters held in this process; expired entries are swept once the table is full."""
+    shared = False
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._windows = {}  # key -> (window index, used, expires_at)
+        self._buckets = {}  # key -> (tokens, updated_at, expires_at)
+
+    def _sweep(self, now):
+        if len(self._windows) + len(self._buckets) < self.max_entries:
+            return
+        self._windows = {k: v for k, v in self._windows.items() if v[2] > now}
+        self._buckets = {k: v for k, v in self._buckets.items() if v[2] > now}
+
+    async def window(self, key, limit, window, cost, now):
+        index = int(now // window)
+        previous, used, _ = self._windows.get(key, (index, 0, 0))
+        if previous != index:
+            used = 0
+        if used + cost > limit:
+            return False, limit - used
+        self._sweep(now)
+        self._windows[key] = (index, used + cost, (index + 1) * window)
+        return True, limit - used - cost
+
+    async def bucket(self, key, capacity, refill_every, cost, now):
+        tokens, updated_at, _ = self._buckets.get(key, (capacity, now, 0))
+        tokens = min(capacity, tokens + (now - updated_at) / refill_every)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._sweep(now)
+        # Forgettable once it would be full again
+        self._buckets[key] = (tokens, now, now + (capacity - tokens) * refill_every)
+        return allowed, tokens
+
+    async def refund_window(self, key, window, cost, now):
+        index = int(now // window)
+        previous, used, expires_at = self._windows.get(key, (index, 0, 0))
+        if previous == index:
+            self._windows[key] = (index, max(0, used - cost), expires_at)
+
+    def size(self):
+        return len(self._windows) + len(self._buckets)
+
+
+class RedisStore:
+    """
+    Counters shared by all workers. Windows are an INCRBY that undoes itself
+    when over the limit; buckets are a WATCH/MULTI read-modify-write, so no
+    server-side scripting is needed.
+    """
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "hq:quota:", client=None):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    async def window(self, key, limit, window, cost, now):
+        index = int(now // window)
+        name = f"{self.prefix}{key}:{index}"
+        pipe = self.client.pipeline()
+        pipe.incrby(name, cost)
+        pipe.expireat(name, (index + 1) * window + 60)
+        used = (await pipe.execute())[0]
+        if used > limit:
+            await self.client.decrby(name, cost)
+            return False, max(0, limit - (used - cost))
+        return True, limit - used
+
+    async def bucket(self, key, capacity, refill_every, cost, now):
+        from redis.exceptions import WatchError
+        name = self.prefix + key
+        for _ in range(10):
+            async with self.client.pipeline() as pipe:
+                try:
+                    await pipe.watch(name)
+                    state = await pipe.hgetall(name)
+                    tokens = float(state.get(b"tokens", capacity))
+                    updated_at = float(state.get(b"updated_at", now))
+                    tokens = min(capacity, tokens + max(0.0, now - updated_at) / refill_every)
+                    allowed = tokens >= cost
+                    if allowed:
+                        tokens -= cost
+                    pipe.multi()
+                    pipe.hset(name, mapping={"tokens": tokens, "updated_at": now})
+                    pipe.expire(name, math.ceil((capacity - tokens) * refill_every) + 60)
+                    await pipe.execute()
+                    return allowed, tokens
+                except WatchError:
+                    continue  # another worker changed the bucket first; re-read it
+        raise RuntimeError(f"Quota bucket {key} is too contended")
+
+    async def refund_window(self, key, window, cost, now):
+        name = f"{self.prefix}{key}:{int(now // window)}"
+        used = await self.client.decrby(name, cost)
+        if used < 0:
+            await self.client.set(name, 0, keepttl=True)
+
+    def size(self):
+        return None
+
+
+class QuotaEngine:
+    def __init__(self, store):
+        self.store = store
+        self.allowed = 0
+        self.rejected = 0
+        self.errors = 0
+
+    @property
+    def shared(self) -> bool:
+        """True when every worker sees the same counters and they outlive restarts."""
+        return self.store.shared
+
+    async def consume(self, policy: Policy, subject, cost: int = 1) -> Decision:
+        """Takes `cost` units from subject's allowance if they are all available."""
+        key = f"{policy.name}:{subject}"
+        now = time.time()
+        try:
+            if isinstance(policy, FixedWindow):
+                allowed, remaining = await self.store.window(key, policy.limit, policy.window, cost, now)
+                retry_after = 0 if allowed else math.ceil((int(now // policy.window) + 1) * policy.window - now)
+            else:
+                allowed, remaining = await self.store.bucket(key, policy.capacity, policy.refill_every, cost, now)
+                retry_after = 0 if allowed else math.ceil((cost - remaining) * policy.refill_every)
+        except Exception as e:
+            # A broken quota store must not lock everybody out: fail open
+            self.errors += 1
+            logger.warning(f"Quota check failed for {key}: {e}")
+            return Decision(True, 0, 0)
+        if allowed:
+            self.allowed += 1
+        else:
+            self.rejected += 1
+        return Decision(allowed, max(0, int(remaining)), max(0, retry_after))
+
+    async def refund(self, policy: Policy, subject, cost: int = 1):
+        """Gives back units taken for an action that then failed (fixed windows only)."""
+        if not isinstance(policy, FixedWindow):
+            return
+        try:
+            await self.store.refund_window(f"{policy.name}:{subject}", policy.window, cost, time.time())
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Quota refund failed for {policy.name}:{subject}: {e}")
+
+    async def enforce(self, policy: Policy, subject, detail: str = "Juda ko'p so'rov, birozdan so'ng qayta urinib ko'ring"):
+        """consume(), answering 429 with Retry-After when the allowance is used up."""
+        decision = await self.consume(policy, subject)
+        if not decision.allowed:
+            raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(decision.retry_after)})
+        return decision
+
+    def stats(self):
+        return {
+            "store": type(self.store).__name__,
+            "shared": self.shared,
+            "entries": self.store.size(),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+
+IMAGE_MESSAGES = FixedWindow("image_messages", limit=int(os.getenv("QUOTA_IMAGE_MESSAGES_PER_DAY", "5")), window=86400)
+OTP_REQUESTS = TokenBucket(
+    "otp",
+    capacity=int(os.getenv("QUOTA_OTP_BURST", "3")),
+    refill_every=float(os.getenv("QUOTA_OTP_REFILL_SECONDS", "60")),
+)
+REPORTS = FixedWindow("reports", limit=int(os.getenv("QUOTA_REPORTS_PER_HOUR", "10")), window=3600)
+
+
+def _from_env() -> QuotaEngine:
+    redis_url = os.getenv("QUOTA_REDIS_URL")
+    if not redis_url and os.getenv("CACHE_BACKEND", "memory").lower() == "redis":
+        redis_url = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+    kind = (os.getenv("QUOTA_BACKEND") or ("redis" if redis_url else "memory")).lower()
+    if kind == "redis":
+        store = RedisStore(redis_url or "redis://localhost:6379/0")
+    else:
+        store = MemoryStore(max_entries=int(os.getenv("QUOTA_MAX_ENTRIES", "100000")))
+    return QuotaEngine(store)
+
+
+engine = _from_env()
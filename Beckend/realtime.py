@@ -0,0 +1,198 @@
+"""
+Real-time chat events over WebSockets.
+
+Clients keep one socket open on /ws/messages?token=<jwt> and receive JSON
+events instead of polling /messages/{user_id} and /messages/chats:
+
+    {"type": "message", "message": {...}}                  new message (to both sides)
+    {"type": "unread", "user_id": 7, "unread_count": 3, "total": 5}
+                                                           conversation counter and badge total changed
+    {"type": "read", "user_id": 7}                         7 read everything you sent them
+
+Endpoints call hub.publish(user_id, event). The broker decides which
+process delivers it, chosen by REALTIME_BROKER:
+
+    memory  (default) this process only; enough for a single uvicorn worker
+    redis   REALTIME_REDIS_URL pub/sub, so every worker sees every event and
+            delivers it to the sockets it holds
+
+Each socket has a bounded outbound queue drained by its own task, so a
+publish never waits on a slow client; a client that falls too far behind
+is disconnected and catches up over HTTP when it reconnects.
+"""
+import asyncio
+import json
+import logging
+import os
+from dotenv import load_dotenv
+from fastapi import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+class MemoryBroker:
+    """Delivers straight to the local hub."""
+
+    async def start(self, deliver):
+        self._deliver = deliver
+
+    async def publish(self, user_id: int, payload: str):
+        self._deliver(user_id, payload)
+
+    async def stop(self):
+        pass
+
+
+class RedisBroker:
+    """
+    One shared channel for all events. Every worker filters for its own
+    sockets, which keeps a single subscription per worker regardless of how
+    many users are online.
+    """
+
+    def __init__(self, url: str, channel: str = "hq:realtime", client=None):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.client = client
+        self.channel = channel
+        self._task = None
+
+    async def start(self, deliver):
+        self._deliver = deliver
+        self._task = asyncio.create_task(self._listen())
+
+    async def publish(self, user_id: int, payload: str):
+        await self.client.publish(self.channel, json.dumps({"user_id": user_id, "payload": payload}))
+
+    async def _listen(self):
+        delay = 1
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                delay = 1
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    event = json.loads(message["data"])
+                    self._deliver(event["user_id"], event["payload"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Events published while disconnected are lost; clients resync over HTTP
+                logger.error(f"Realtime subscription lost, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+            finally:
+                await pubsub.aclose()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.client.aclose()
+
+
+class _Connection:
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(queue_size)
+
+
+class RealtimeHub:
+    def __init__(self, broker, queue_size: int):
+        self.broker = broker
+        self.queue_size = queue_size
+        self._connections = {}  # user_id -> set of _Connection
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.publish_errors = 0
+
+    async def start(self):
+        await self.broker.start(self._deliver)
+
+    async def stop(self):
+        await self.broker.stop()
+        for connections in list(self._connections.values()):
+            for connection in list(connections):
+                try:
+                    await connection.websocket.close(code=1001)
+                except Exception:
+                    pass  # already gone
+
+    async def publish(self, user_id: int, event: dict):
+        """Sends event to every socket of user_id, in any worker. Never raises: delivery is best effort."""
+        self.published += 1
+        try:
+            await self.broker.publish(user_id, json.dumps(event, default=str))
+        except Exception as e:
+            self.publish_errors += 1
+            logger.error(f"Realtime publish failed for user {user_id}: {e}")
+
+    def _deliver(self, user_id: int, payload: str):
+        for connection in list(self._connections.get(user_id, ())):
+            try:
+                connection.queue.put_nowait(payload)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                # Too slow to keep up: disconnect rather than buffer without bound
+                self.dropped += 1
+                connection.queue = None
+                asyncio.create_task(connection.websocket.close(code=1013))
+                self._remove(user_id, connection)
+
+    def _remove(self, user_id: int, connection: _Connection):
+        connections = self._connections.get(user_id)
+        if connections:
+            connections.discard(connection)
+            if not connections:
+                del self._connections[user_id]
+
+    async def _send(self, connection: _Connection):
+        while connection.queue is not None:
+            payload = await connection.queue.get()
+            await connection.websocket.send_text(payload)
+
+    async def serve(self, user_id: int, websocket: WebSocket):
+        """Runs an accepted socket until either side closes it."""
+        connection = _Connection(websocket, self.queue_size)
+        self._connections.setdefault(user_id, set()).add(connection)
+        sender = asyncio.create_task(self._send(connection))
+        try:
+            while True:
+                # Application-level keepalive for clients that can't see protocol pings
+                if await websocket.receive_text() == "ping":
+                    await websocket.send_text('{"type": "pong"}')
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # closed by the client, or by us after a failed send
+        finally:
+            self._remove(user_id, connection)
+            sender.cancel()
+
+    def stats(self):
+        return {
+            "broker": type(self.broker).__name__,
+            "users": len(self._connections),
+            "connections": sum(len(c) for c in self._connections.values()),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "publish_errors": self.publish_errors,
+        }
+
+
+def _from_env() -> RealtimeHub:
+    kind = os.getenv("REALTIME_BROKER", "memory").lower()
+    if kind == "redis":
+        broker = RedisBroker(os.getenv("REALTIME_REDIS_URL", os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")))
+    else:
+        broker = MemoryBroker()
+    return RealtimeHub(broker, queue_size=int(os.getenv("REALTIME_QUEUE_SIZE", "100")))
+
+
+hub = _from_env()
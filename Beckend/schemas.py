@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 from enum import Enum
 
@@ -46,9 +46,13 @@ class Profile(ProfileBase):
     class Config:
         from_attributes = True
 
+# Responsive renditions of one uploaded image: {"thumb"|"card"|"full": {"webp": url, "jpeg": url}}.
+# Clients pick the smallest size that fits and fall back to the original URL when a size is missing.
+ImageVariants = Dict[str, Dict[str, str]]
+
 class PortfolioItemBase(BaseModel):
     title: str
-    image_url1: str
+    image_url1: Optional[str] = None  # empty until the item's background image jobs finish
     image_url2: Optional[str] = None
     image_url3: Optional[str] = None
     image_url4: Optional[str] = None
@@ -69,6 +73,8 @@ class PortfolioItemCreate(PortfolioItemBase):
 class PortfolioItem(PortfolioItemBase):
     id: int
     profile_id: int
+    image_variants: Optional[List[Optional[ImageVariants]]] = None  # aligned with image_url1..5
+    processing_state: Optional[str] = "ready"  # processing, ready or failed; see image_jobs
 
     class Config:
         from_attributes = True
@@ -88,6 +94,27 @@ class PortfolioItemPublic(PortfolioItem):
     class Config:
         from_attributes = True
 
+class ImageJob(BaseModel):
+    slot: int
+    status: str
+    attempts: int
+    last_error: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+class PortfolioItemStatus(BaseModel):
+    item_id: int
+    status: str
+    total: int
+    done: int
+    failed: int
+    jobs: List[ImageJob]
+
+class PortfolioItemPage(BaseModel):
+    items: List[PortfolioItemPublic]
+    next_cursor: Optional[int] = None  # pass as before_id to fetch the next page
+
 # Reviews removed from here, using the ones at the bottom
 
 class Token(BaseModel):
@@ -120,12 +147,21 @@ class MessageCreate(MessageBase):
 class Message(MessageBase):
     id: int
     sender_id: int
+    image_variants: Optional[ImageVariants] = None
     is_read: bool
     created_at: datetime
 
     class Config:
         from_attributes = True
 
+class MessagePage(BaseModel):
+    items: List[Message]  # oldest first, as the chat renders them
+    # before_id mode: pass as before_id for older messages; since_id mode: pass as since_id for the rest
+    next_cursor: Optional[int] = None
+
+class UnreadCount(BaseModel):
+    total: int
+
 class ReviewBase(BaseModel):
     stars: int
     text: Optional[str] = None
@@ -0,0 +1,253 @@
+"""
+Where uploaded images are hosted.
+
+STORAGE_BACKEND selects the implementation:
+
+    imagekit  (default) ImageKit CDN; every upload is a WAN round trip
+    local     content-addressed files under MEDIA_ROOT, served by this API
+              at /media/... or, with MEDIA_ACCEL_REDIRECT set, by nginx
+
+Backends return (url, file_id) from put() and take that file_id in
+delete(). Reference counting lives in image_utils, not here.
+"""
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import random
+import tempfile
+from abc import ABC, abstractmethod
+
+import httpx
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, Response
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Content-addressed files never change, so clients and proxies may cache them forever
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+
+class StorageBackend(ABC):
+    name = "base"
+
+    @abstractmethod
+    async def put(self, content: bytes, file_name: str, folder: str):
+        """Stores content; returns (url, file_id)."""
+
+    @abstractmethod
+    async def delete(self, file_id: str):
+        ...
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+# Failures that prove the request never reached ImageKit, so even an upload can be resent
+_CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+_SAFE_STATUSES = {429, 503}
+# Ambiguous failures (the server may have acted): only retried for idempotent calls like delete
+_TRANSIENT_STATUSES = {408, 500, 502, 504}
+
+
+def _retryable(exc: Exception, idempotent: bool) -> bool:
+    from imagekitio import APIConnectionError, APIStatusError
+    if isinstance(exc, APIStatusError):
+        return exc.status_code in _SAFE_STATUSES or (idempotent and exc.status_code in _TRANSIENT_STATUSES)
+    if isinstance(exc, APIConnectionError):  # includes APITimeoutError
+        return idempotent or isinstance(exc.__cause__, _CONNECT_ERRORS)
+    return False
+
+
+class ImageKitStorage(StorageBackend):
+    """
+    One shared AsyncImageKit client for the process: a keep-alive connection
+    pool sized to max_concurrency, a semaphore so bursts queue here instead
+    of opening dozens of upstream connections, and full-jitter exponential
+    backoff for failures that are safe to retry.
+    """
+    name = "imagekit"
+
+    def __init__(self, private_key: str, max_concurrency: int, max_retries: int,
+                 backoff_base: float, backoff_max: float, timeout: float):
+        from imagekitio import AsyncImageKit, DefaultAsyncHttpxClient
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.client = AsyncImageKit(
+            private_key=private_key,
+            # Retries are ours: the SDK's would also resend uploads after ambiguous failures
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                timeout=httpx.Timeout(timeout, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=max_concurrency,
+                    max_keepalive_connections=max_concurrency,
+                    keepalive_expiry=60.0,
+                ),
+            ),
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    async def _call(self, fn, idempotent: bool):
+        attempt = 0
+        while True:
+            self.waiting += 1
+            async with self._semaphore:
+                self.waiting -= 1
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                self.requests += 1
+                try:
+                    return await fn()
+                except Exception as e:
+                    error = e
+                finally:
+                    self.in_flight -= 1
+            if attempt >= self.max_retries or not _retryable(error, idempotent):
+                self.failures += 1
+                raise error
+            attempt += 1
+            self.retries += 1
+            # Sleep outside the semaphore so other uploads use the slot meanwhile
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            logger.warning(f"ImageKit call failed ({error!r}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def put(self, content, file_name, folder):
+        upload = await self._call(lambda: self.client.files.upload(
+            file=content,
+            file_name=file_name,
+            folder=folder,
+            use_unique_file_name=True
+        ), idempotent=False)
+        return upload.url, upload.file_id
+
+    async def delete(self, file_id):
+        await self._call(lambda: self.client.files.delete(file_id), idempotent=True)
+
+    async def close(self):
+        await self.client.close()
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "peak_in_flight": self.peak_in_flight,
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+
+def _sniff_extension(content):
+    """Extension for the bytes actually stored; the upload's name describes the file before processing."""
+    if content[:3] == b"\xff\xd8\xff":
+        return ".jpg"
+    if content[:8] == b"\x89PNG\r\n\x1a\n":
+        return ".png"
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return ".webp"
+    if content[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    return None
+
+
+class LocalStorage(StorageBackend):
+    """
+    Files live at <root>/<folder>/<ab>/<cd>/<sha256><ext>, so storing the same
+    bytes twice is a no-op and the file_id is the relative path.
+    """
+    name = "local"
+
+    def __init__(self, root: str, base_url: str, accel_prefix: str = None):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+        self.accel_prefix = accel_prefix.rstrip("/") + "/" if accel_prefix else None
+
+    def _relative_path(self, content, file_name, folder):
+        digest = hashlib.sha256(content).hexdigest()
+        ext = _sniff_extension(content) or os.path.splitext(file_name or "")[1].lower() or ".bin"
+        parts = [p for p in (folder or "").split("/") if p and p not in (".", "..")]
+        return "/".join(parts + [digest[:2], digest[2:4], digest + ext])
+
+    def _absolute_path(self, relative_path):
+        path = os.path.abspath(os.path.join(self.root, relative_path))
+        # Never resolve outside MEDIA_ROOT, whatever the request path contains
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise HTTPException(status_code=404, detail="Fayl topilmadi")
+        return path
+
+    def _write(self, content, path):
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            # Atomic rename: readers never see a half-written file
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    async def put(self, content, file_name, folder):
+        relative_path = self._relative_path(content, file_name, folder)
+        await asyncio.to_thread(self._write, content, self._absolute_path(relative_path))
+        return f"{self.base_url}/{relative_path}", relative_path
+
+    async def delete(self, file_id):
+        try:
+            await asyncio.to_thread(os.unlink, self._absolute_path(file_id))
+        except FileNotFoundError:
+            pass
+
+    def response(self, relative_path: str):
+        """Serves a stored file: nginx internal redirect when configured, else sendfile via FileResponse."""
+        path = self._absolute_path(relative_path)
+        if not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail="Fayl topilmadi")
+        headers = {"Cache-Control": IMMUTABLE_CACHE}
+        if self.accel_prefix:
+            headers["X-Accel-Redirect"] = self.accel_prefix + relative_path
+            media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            return Response(headers=headers, media_type=media_type)
+        return FileResponse(path, headers=headers)
+
+
+def _from_env() -> StorageBackend:
+    backend = os.getenv("STORAGE_BACKEND", "imagekit").lower()
+    if backend == "local":
+        return LocalStorage(
+            root=os.getenv("MEDIA_ROOT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media")),
+            base_url=os.getenv("MEDIA_BASE_URL", "/media"),
+            accel_prefix=os.getenv("MEDIA_ACCEL_REDIRECT") or None,
+        )
+    return ImageKitStorage(
+        private_key=os.getenv("IMAGEKIT_PRIVATE_KEY"),
+        max_concurrency=int(os.getenv("IMAGEKIT_MAX_CONCURRENCY", "8")),
+        max_retries=int(os.getenv("IMAGEKIT_MAX_RETRIES", "3")),
+        backoff_base=float(os.getenv("IMAGEKIT_BACKOFF_BASE", "0.5")),
+        backoff_max=float(os.getenv("IMAGEKIT_BACKOFF_MAX", "10")),
+        timeout=float(os.getenv("IMAGEKIT_TIMEOUT", "300")),
+    )
+
+
+storage = _from_env()
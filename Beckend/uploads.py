@@ -0,0 +1,147 @@
+"""
+Size-capped, streaming ingestion of uploaded image files.
+
+Starlette parses the whole multipart body before a handler runs, spooling
+each file to an anonymous temp file past 1 MB. BodySizeLimitMiddleware is
+what bounds that: it refuses a request whose Content-Length is over
+MAX_REQUEST_MB straight away, and stops reading a chunked body once it
+passes the limit, so an oversize payload is never parsed or stored.
+
+spool_upload then makes a second, named copy in fixed-size chunks instead
+of `await file.read()` (the whole upload in memory). The copy is what the
+image engine workers open by path, and what background jobs keep across
+restarts, so raw bytes are never held in the API process or pickled across
+the process boundary. Per-file it rejects non-images from their first bytes
+(magic numbers, not the client-supplied content type) and files over
+MAX_UPLOAD_MB.
+"""
+import os
+import tempfile
+from typing import Optional
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024
+# A whole request: up to five portfolio images plus the form fields
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_MB", str(MAX_UPLOAD_BYTES * 5 // (1024 * 1024) + 1))) * 1024 * 1024
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR") or tempfile.gettempdir()
+CHUNK_SIZE = 1024 * 1024
+
+_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+]
+
+# ISO-BMFF brands of the formats phone cameras produce
+_FTYP_BRANDS = {b"heic", b"heix", b"hevc", b"mif1", b"msf1", b"avif"}
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Returns the image format from the file's first bytes, or None for non-images."""
+    for signature, kind in _SIGNATURES:
+        if head.startswith(signature):
+            return kind
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in _FTYP_BRANDS:
+        return "heif"
+    return None
+
+
+class SpooledUpload:
+    """An upload copied to disk; close() removes the temp file."""
+
+    def __init__(self, path: str, size: int, kind: str, filename: str):
+        self.path = path
+        self.size = size
+        self.kind = kind
+        self.filename = filename
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+def _too_large(max_bytes: int):
+    return HTTPException(
+        status_code=413,
+        detail=f"Fayl hajmi juda katta (maksimal {max_bytes // (1024 * 1024)} MB)"
+    )
+
+
+class BodySizeLimitMiddleware:
+    """Rejects request bodies over max_bytes with 413 before the app (or the multipart parser) reads them."""
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            too_large = _too_large(self.max_bytes)
+            return await JSONResponse({"detail": too_large.detail}, status_code=413)(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                # Chunked bodies have no Content-Length to check up front
+                if received > self.max_bytes:
+                    raise _too_large(self.max_bytes)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+async def spool_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES, directory: str = None) -> SpooledUpload:
+    """
+    Copies an UploadFile to a temp file chunk by chunk, validating type and size.
+    directory defaults to UPLOAD_TMP_DIR; background jobs pass a persistent one.
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise _too_large(max_bytes)
+
+    head = await file.read(CHUNK_SIZE)
+    kind = sniff_image_type(head)
+    if kind is None:
+        raise HTTPException(status_code=415, detail="Faqat rasm fayllarini yuklash mumkin")
+
+    fd, path = tempfile.mkstemp(prefix="upload-", suffix=f".{kind}", dir=directory or UPLOAD_TMP_DIR)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            chunk = head
+            while chunk:
+                size += len(chunk)
+                # Clients can lie about Content-Length, so enforce the cap while copying too
+                if size > max_bytes:
+                    raise _too_large(max_bytes)
+                out.write(chunk)
+                chunk = await file.read(CHUNK_SIZE)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return SpooledUpload(path, size, kind, file.filename)
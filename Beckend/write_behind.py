@@ -0,0 +1,150 @@
+"""
+Write-behind buffers for high-frequency counters.
+
+Endpoints record events in memory in O(1); a background task flushes the
+aggregated batch to the database every few seconds and once more on
+shutdown. If a flush fails the batch is merged back and retried on the
+next tick, so nothing is dropped while the process stays up.
+"""
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import Counter
+
+from sqlalchemy import update, bindparam, func
+from dotenv import load_dotenv
+
+import models
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+class BufferedWriter(ABC):
+    """Base class: subclasses implement _take, _restore, _write and pending."""
+
+    def __init__(self, name: str, interval: float):
+        self.name = name
+        self.interval = interval
+        self.flushes = 0
+        self.failures = 0
+        self._task = None
+        self._early_flush = None
+        self._lock = asyncio.Lock()
+
+    @abstractmethod
+    def _take(self):
+        """Detaches and returns the pending batch (or None when empty)."""
+
+    @abstractmethod
+    def _restore(self, batch):
+        """Puts a batch that failed to write back into the buffer."""
+
+    @abstractmethod
+    async def _write(self, batch):
+        ...
+
+    @abstractmethod
+    def pending(self) -> int:
+        ...
+
+    def _flush_soon(self):
+        """Flushes without waiting for the next tick, once at a time; the reference keeps the task from being collected."""
+        if self._early_flush is None or self._early_flush.done():
+            self._early_flush = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        async with self._lock:
+            batch = self._take()
+            if not batch:
+                return
+            try:
+                await self._write(batch)
+                self.flushes += 1
+            except Exception as e:
+                self.failures += 1
+                self._restore(batch)
+                logger.error(f"{self.name} flush failed, will retry: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._early_flush is not None:
+            await self._early_flush
+            self._early_flush = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "pending": self.pending(),
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "interval": self.interval,
+        }
+
+
+class ViewCounterBuffer(BufferedWriter):
+    """Aggregates portfolio item views as item_id -> delta."""
+
+    def __init__(self, interval: float, max_pending: int):
+        super().__init__("View counter", interval)
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._deltas = Counter()
+
+    def add(self, item_id: int, count: int = 1):
+        # item_id comes straight from the URL: bound the distinct keys so random ids can't grow the buffer
+        if item_id not in self._deltas and len(self._deltas) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._deltas[item_id] += count
+        if len(self._deltas) == self.max_pending:
+            self._flush_soon()
+
+    def pending(self) -> int:
+        return len(self._deltas)
+
+    def _take(self):
+        batch, self._deltas = self._deltas, Counter()
+        return batch
+
+    def _restore(self, batch):
+        self._deltas.update(batch)
+
+    async def _write(self, batch):
+        table = models.PortfolioItem.__table__
+        # Increment in SQL so concurrent workers never overwrite each other's counts
+        stmt = update(table).where(table.c.id == bindparam("item_id")).values(
+            views_count=func.coalesce(table.c.views_count, 0) + bindparam("delta")
+        )
+        async with AsyncSessionLocal() as db:
+            await db.execute(stmt, [{"item_id": item_id, "delta": delta} for item_id, delta in batch.items()])
+            await db.commit()
+
+    def stats(self):
+        stats = super().stats()
+        stats["dropped"] = self.dropped
+        return stats
+
+
+view_counter = ViewCounterBuffer(
+    interval=float(os.getenv("VIEW_FLUSH_INTERVAL", "5")),
+    max_pending=int(os.getenv("VIEW_MAX_PENDING", "50000")),
+)